@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+External-memory join of experiment assignments with metric events.
+
+Attributes metric events (keyed by CONTEXT_KEY) to hero banner variants from
+experiment_assignments.jsonl (keyed by user_key) without holding either side
+in memory, using a Grace hash join:
+
+1. Partition: every input file is split into byte ranges; worker processes
+   stream their ranges, hash each key with a stable CRC32 and spill compact
+   records to per-partition run files. The partition count is chosen so one
+   partition's assignments fit the --memory-mb budget.
+2. Join: each partition is joined by one worker. It builds a user_key ->
+   assignment table from the partition's assignment runs (first assignment
+   per user wins), then streams the partition's event runs. Partitions that
+   still exceed the budget (key skew) are re-partitioned with a salted
+   BLAKE2b hash (independent of the CRC32 split and of other levels)
+   before joining.
+
+Outputs one CSV table per variant (a directory of part files, one per
+partition) plus summary.json with per-variant event counts and value sums,
+throughput and peak memory. Event inputs may be JSONL (metric spool
+segments, lowercase keys) or CSV exports of the metric events table
+(uppercase Snowflake column names).
+
+    python attribution_join.py --assignments experiment_assignments.jsonl \\
+        --events exports/*.csv metric_spool/segment-*.jsonl --out attribution --workers 4
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import zlib
+import hashlib
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from collections import defaultdict
+
+from gravityfarms_simulation import configure_logging, hero_banner_variant
+
+logger = logging.getLogger('gravityfarms-join')
+
+OUTPUT_COLUMNS = ['event_id', 'event_key', 'context_key', 'event_value', 'received_time',
+                  'variant', 'trial_days', 'seasonal_banner']
+
+RANGE_BYTES = 64 * 1024 * 1024
+# Rough in-memory size of one assignment table entry relative to its spilled record
+TABLE_OVERHEAD = 5
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    """Peak resident set size (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+def partition_of(key, partitions, salt=0):
+    """
+    Stable partition of key; every salt gives an independent hash.
+
+    zlib.crc32 is stable across processes, unlike the randomized built-in
+    hash(), and is fast enough for the top-level split. Re-splits must not
+    reuse it with a different starting value: CRC32 is affine in that value
+    for equal-length keys (UUIDs), so a skewed partition would land in a
+    single sub-partition again. They use salted BLAKE2b instead.
+    """
+    data = key.encode('utf-8')
+    if not salt:
+        return zlib.crc32(data) % partitions
+    digest = hashlib.blake2b(data, digest_size=8, salt=salt.to_bytes(16, 'little')).digest()
+    return int.from_bytes(digest, 'little') % partitions
+
+
+def split_ranges(path, range_bytes=RANGE_BYTES):
+    """Split a file into (path, start, end) byte ranges; CSV files are never split."""
+    size = os.path.getsize(path)
+    if path.endswith('.csv') or size <= range_bytes:
+        return [(path, 0, size)]
+    return [(path, start, min(start + range_bytes, size)) for start in range(0, size, range_bytes)]
+
+
+def iter_range_lines(path, start, end):
+    """Yield the lines that start inside [start, end)."""
+    with open(path, 'rb') as f:
+        if start:
+            # The line straddling start belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def _first(record, *names):
+    for name in names:
+        if name in record:
+            return record[name]
+    return None
+
+
+def iter_assignments(path, start, end):
+    """Yield compact [user_key, variant, trial_days, seasonal_banner, timestamp] records."""
+    for line in iter_range_lines(path, start, end):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        key = entry.get('user_key')
+        if not key:
+            continue
+        yield [
+            key,
+            hero_banner_variant(entry.get('hero_banner_detail', {}).get('value')),
+            entry.get('trial_days_detail', {}).get('value'),
+            entry.get('seasonal_banner'),
+            entry.get('timestamp', ''),
+        ]
+
+
+def iter_events(path, start, end):
+    """Yield compact [context_key, event_id, event_key, event_value, received_time] records."""
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            rows = csv.DictReader(f)
+            for row in rows:
+                row = {k.lower(): v for k, v in row.items() if k}
+                if row.get('context_key'):
+                    value = row.get('event_value')
+                    yield [row['context_key'], row.get('event_id'), row.get('event_key'),
+                           float(value) if value not in (None, '') else None, row.get('received_time')]
+        return
+    for line in iter_range_lines(path, start, end):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        key = _first(event, 'context_key', 'CONTEXT_KEY')
+        if not key:
+            continue
+        yield [key, _first(event, 'event_id', 'EVENT_ID'), _first(event, 'event_key', 'EVENT_KEY'),
+               _first(event, 'event_value', 'EVENT_VALUE'), _first(event, 'received_time', 'RECEIVED_TIME')]
+
+
+READERS = {'assign': iter_assignments, 'events': iter_events}
+
+
+class RunWriter:
+    """Buffered writers for one task's per-partition spill files."""
+
+    def __init__(self, spill_dir, prefix, partitions, buffer_bytes):
+        self.spill_dir = spill_dir
+        self.prefix = prefix
+        self.partitions = partitions
+        self.buffer_bytes = buffer_bytes
+        self._files = {}
+
+    def write(self, partition, record):
+        f = self._files.get(partition)
+        if f is None:
+            path = os.path.join(self.spill_dir, f"{self.prefix}-p{partition:05d}.jsonl")
+            f = self._files[partition] = open(path, 'w', buffering=self.buffer_bytes)
+        f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+
+def partition_task(task):
+    """Spill one input byte range into partition run files; returns (side, records, bytes read)."""
+    side, task_id, path, start, end, spill_dir, partitions, buffer_bytes = task
+    writer = RunWriter(spill_dir, f"{side}-t{task_id:05d}", partitions, buffer_bytes)
+    records = 0
+    try:
+        for record in READERS[side](path, start, end):
+            writer.write(partition_of(record[0], partitions), record)
+            records += 1
+    finally:
+        writer.close()
+    return side, records, end - start, peak_rss_bytes()
+
+
+def _run_files(spill_dir, side, partition):
+    suffix = f"-p{partition:05d}.jsonl"
+    return sorted(
+        os.path.join(spill_dir, name) for name in os.listdir(spill_dir)
+        if name.startswith(side + '-') and name.endswith(suffix)
+    )
+
+
+def _iter_runs(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def _repartition(assign_paths, event_paths, work_dir, fanout, salt, buffer_bytes):
+    """Split an oversized partition into fanout sub-partitions with a new hash salt."""
+    os.makedirs(work_dir, exist_ok=True)
+    for side, paths in (('assign', assign_paths), ('events', event_paths)):
+        writer = RunWriter(work_dir, f"{side}-s{salt}", fanout, buffer_bytes)
+        try:
+            for record in _iter_runs(paths):
+                writer.write(partition_of(record[0], fanout, salt), record)
+        finally:
+            writer.close()
+    return [(_run_files(work_dir, 'assign', p), _run_files(work_dir, 'events', p)) for p in range(fanout)]
+
+
+def _join(assign_paths, event_paths, writers, totals, budget_bytes, work_dir, buffer_bytes, depth=0):
+    assign_bytes = sum(os.path.getsize(p) for p in assign_paths)
+    if assign_bytes * TABLE_OVERHEAD > budget_bytes and depth < 3:
+        fanout = max(2, math.ceil(assign_bytes * TABLE_OVERHEAD / budget_bytes))
+        sub_dir = os.path.join(work_dir, f"depth{depth + 1}")
+        totals['repartitioned'] += 1
+        for sub_assign, sub_events in _repartition(assign_paths, event_paths, sub_dir, fanout, depth + 1, buffer_bytes):
+            _join(sub_assign, sub_events, writers, totals, budget_bytes, sub_dir, buffer_bytes, depth + 1)
+        shutil.rmtree(sub_dir, ignore_errors=True)
+        return
+
+    table = {}
+    for key, variant, trial_days, seasonal_banner, timestamp in _iter_runs(assign_paths):
+        current = table.get(key)
+        if current is None or timestamp < current[3]:
+            table[key] = (variant, trial_days, seasonal_banner, timestamp)
+        totals['assignments'] += 1
+    totals['users'] += len(table)
+
+    for key, event_id, event_key, event_value, received_time in _iter_runs(event_paths):
+        totals['events'] += 1
+        assignment = table.get(key)
+        if assignment is None:
+            totals['unassigned'] += 1
+            continue
+        variant, trial_days, seasonal_banner, _ = assignment
+        writers(variant).writerow([event_id, event_key, key, event_value, received_time,
+                                   variant, trial_days, seasonal_banner])
+        stats = totals['variants'][variant][event_key]
+        stats[0] += 1
+        if event_value is not None:
+            stats[1] += 1
+            stats[2] += float(event_value)
+
+
+def join_task(task):
+    """Join one partition and write its rows to each variant's table; returns partial totals."""
+    partition, spill_dir, out_dir, budget_bytes, buffer_bytes = task
+    files = {}
+    totals = {'assignments': 0, 'users': 0, 'events': 0, 'unassigned': 0, 'repartitioned': 0,
+              'variants': defaultdict(lambda: defaultdict(lambda: [0, 0, 0.0]))}
+
+    def writer_for(variant):
+        if variant not in files:
+            table_dir = os.path.join(out_dir, variant.lower().replace(' ', '_'))
+            os.makedirs(table_dir, exist_ok=True)
+            f = open(os.path.join(table_dir, f"part-{partition:05d}.csv"), 'w', newline='', buffering=buffer_bytes)
+            writer = csv.writer(f)
+            writer.writerow(OUTPUT_COLUMNS)
+            files[variant] = (f, writer)
+        return files[variant][1]
+
+    try:
+        _join(_run_files(spill_dir, 'assign', partition), _run_files(spill_dir, 'events', partition),
+              writer_for, totals, budget_bytes, os.path.join(spill_dir, f"skew-p{partition:05d}"), buffer_bytes)
+    finally:
+        for f, _ in files.values():
+            f.close()
+    totals['variants'] = {v: {k: list(s) for k, s in by_event.items()} for v, by_event in totals['variants'].items()}
+    totals['peak_rss_bytes'] = peak_rss_bytes()
+    return totals
+
+
+def run_join(assignment_paths, event_paths, out_dir, workers=1, memory_mb=256, spill_dir=None,
+             partitions=None, keep_spill=False):
+    """Partition both inputs to disk, join partition by partition and write per-variant tables."""
+    budget_bytes = memory_mb * 1024 * 1024
+    assign_bytes = sum(os.path.getsize(p) for p in assignment_paths)
+    if partitions is None:
+        # Assignment records shrink when spilled, so input bytes over-estimate each partition
+        partitions = max(workers, math.ceil(assign_bytes * TABLE_OVERHEAD / budget_bytes))
+    # Every open run file gets a write buffer; keep their total within a quarter of the budget
+    buffer_bytes = max(4096, min(1024 * 1024, budget_bytes // (4 * partitions)))
+
+    os.makedirs(out_dir, exist_ok=True)
+    spill_dir = spill_dir or tempfile.mkdtemp(prefix='attribution-spill-', dir=out_dir)
+    os.makedirs(spill_dir, exist_ok=True)
+    logger.info(f"Joining {len(assignment_paths)} assignment and {len(event_paths)} event files "
+                f"({partitions} partitions, {workers} workers, {memory_mb} MB budget, spill dir {spill_dir})")
+
+    tasks = []
+    for side, paths in (('assign', assignment_paths), ('events', event_paths)):
+        for path in paths:
+            for path_, start, end in split_ranges(path):
+                tasks.append((side, len(tasks), path_, start, end, spill_dir, partitions, buffer_bytes))
+
+    report = {'partitions': partitions, 'workers': workers, 'memory_mb': memory_mb}
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    mapper = pool.imap_unordered if pool else map
+    try:
+        start = time.perf_counter()
+        records = {'assign': 0, 'events': 0}
+        bytes_read = 0
+        worker_peak = 0
+        for side, count, size, rss in mapper(partition_task, tasks):
+            records[side] += count
+            bytes_read += size
+            worker_peak = max(worker_peak, rss)
+        elapsed = time.perf_counter() - start
+        report['partition_phase'] = {
+            'seconds': elapsed,
+            'assignment_records': records['assign'],
+            'event_records': records['events'],
+            'records_per_second': sum(records.values()) / elapsed if elapsed else 0.0,
+            'mb_per_second': bytes_read / elapsed / (1024 * 1024) if elapsed else 0.0,
+        }
+        logger.info(f"Partitioned {sum(records.values()):,} records in {elapsed:.2f}s "
+                    f"({report['partition_phase']['records_per_second']:,.0f} records/s)")
+
+        start = time.perf_counter()
+        summary = defaultdict(lambda: defaultdict(lambda: [0, 0, 0.0]))
+        counts = defaultdict(int)
+        join_tasks = [(p, spill_dir, out_dir, budget_bytes, buffer_bytes) for p in range(partitions)]
+        for totals in mapper(join_task, join_tasks):
+            for field in ('assignments', 'users', 'events', 'unassigned', 'repartitioned'):
+                counts[field] += totals[field]
+            worker_peak = max(worker_peak, totals['peak_rss_bytes'])
+            for variant, by_event in totals['variants'].items():
+                for event_key, (n, value_count, value_sum) in by_event.items():
+                    s = summary[variant][event_key]
+                    s[0] += n
+                    s[1] += value_count
+                    s[2] += value_sum
+        elapsed = time.perf_counter() - start
+        report['join_phase'] = {
+            'seconds': elapsed,
+            'events_per_second': counts['events'] / elapsed if elapsed else 0.0,
+            **counts,
+        }
+        logger.info(f"Joined {counts['events']:,} events in {elapsed:.2f}s "
+                    f"({report['join_phase']['events_per_second']:,.0f} events/s, "
+                    f"{counts['unassigned']:,} without an assignment)")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if not keep_spill:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    report['variants'] = {
+        variant: {
+            event_key: {'events': n, 'value_count': value_count, 'value_sum': round(value_sum, 2),
+                        'value_mean': value_sum / value_count if value_count else None}
+            for event_key, (n, value_count, value_sum) in sorted(by_event.items())
+        }
+        for variant, by_event in sorted(summary.items())
+    }
+    report['peak_rss_bytes'] = {
+        'coordinator': peak_rss_bytes(),
+        'worker': worker_peak if pool else peak_rss_bytes(),
+    }
+    with open(os.path.join(out_dir, 'summary.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def print_report(report):
+    print(f"{'Variant':<16} {'Event':<26} {'Events':>10} {'Value sum':>12} {'Value mean':>11}")
+    for variant, by_event in report['variants'].items():
+        for event_key, s in by_event.items():
+            mean = f"{s['value_mean']:.2f}" if s['value_mean'] is not None else '-'
+            print(f"{variant:<16} {event_key:<26} {s['events']:>10,} {s['value_sum']:>12,.2f} {mean:>11}")
+    p, j = report['partition_phase'], report['join_phase']
+    print(f"Partition phase: {p['seconds']:.2f}s, {p['records_per_second']:,.0f} records/s, {p['mb_per_second']:.1f} MB/s")
+    print(f"Join phase: {j['seconds']:.2f}s, {j['events_per_second']:,.0f} events/s, "
+          f"{j['users']:,} users, {j['unassigned']:,} unassigned events, {j['repartitioned']} skewed partitions split")
+    rss = report['peak_rss_bytes']
+    print(f"Peak RSS: coordinator {rss['coordinator'] / 2**20:.0f} MB, worker {rss['worker'] / 2**20:.0f} MB")
+
+
+def main():
+    configure_logging()
+    parser = argparse.ArgumentParser(description='Attribute metric events to experiment variants with an external-memory join')
+    parser.add_argument('--assignments', nargs='+', default=['experiment_assignments.jsonl'], help='Assignment log JSONL files')
+    parser.add_argument('--events', nargs='+', required=True, help='Metric event files (JSONL or CSV export with CONTEXT_KEY)')
+    parser.add_argument('--out', default='attribution', help='Output directory for per-variant tables and summary.json')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+    parser.add_argument('--memory-mb', type=int, default=256, help='Per-worker memory budget for one partition')
+    parser.add_argument('--partitions', type=int, help='Override the computed partition count')
+    parser.add_argument('--spill-dir', help='Directory for partition run files (default: inside --out)')
+    parser.add_argument('--keep-spill', action='store_true', help='Keep partition run files after the join')
+    args = parser.parse_args()
+
+    report = run_join(args.assignments, args.events, args.out, workers=args.workers, memory_mb=args.memory_mb,
+                      spill_dir=args.spill_dir, partitions=args.partitions, keep_spill=args.keep_spill)
+    print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+"""
+Distributed load generation for the Gravity Farms simulation.
+
+A coordinator hands out user-key ranges and a per-worker rate budget over a
+socket. Workers (separate processes on this or other hosts) pull ranges, run
+simulate_user_journey_v2 for each user, and stream back counters and
+heartbeats. When a worker stops heartbeating or disconnects, the unfinished
+part of its range is requeued. Whenever a worker joins or leaves, the
+coordinator pushes the rebalanced per-worker rate to every live worker.
+
+Messages are pickled, so anyone holding the authkey can run code on the
+other end. The built-in default key is only accepted on loopback addresses;
+set GRAVITYFARMS_CLUSTER_AUTHKEY to a shared secret for multi-host runs.
+
+Everything can be exercised on one machine:
+
+    python distributed.py local --workers 4 --records 20000 --rate 2000 --offline
+"""
+
+import os
+import sys
+import time
+import uuid
+import queue
+import socket
+import itertools
+import ipaddress
+import logging
+import argparse
+import threading
+import subprocess
+from collections import deque, defaultdict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from gravityfarms_simulation import configure_logging, simulate_user_journey_v2
+
+logger = logging.getLogger('gravityfarms-distributed')
+
+DEFAULT_ADDRESS = '127.0.0.1:6000'
+DEFAULT_AUTHKEY = 'gravityfarms'
+HEARTBEAT_INTERVAL = 1.0
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def get_authkey(address):
+    """Return the cluster authkey; the public default is refused for non-loopback addresses."""
+    key = os.getenv('GRAVITYFARMS_CLUSTER_AUTHKEY')
+    if key:
+        return key.encode('utf-8')
+    if not is_loopback(parse_address(address)[0]):
+        raise ValueError(f"{address} is not a loopback address: set GRAVITYFARMS_CLUSTER_AUTHKEY to a shared "
+                         f"secret on every node (cluster messages are pickled, so the key guards code execution)")
+    return DEFAULT_AUTHKEY.encode('utf-8')
+
+
+class Coordinator:
+    """Hands out user-key ranges, tracks worker liveness and aggregates counters."""
+
+    def __init__(self, address, records, range_size=500, rate=None, heartbeat_timeout=5.0):
+        self.address = address
+        self.records = records
+        self.rate = rate
+        self.heartbeat_timeout = heartbeat_timeout
+        self.run_id = uuid.uuid4().hex[:8]
+
+        self._lock = threading.Lock()
+        self._pending = deque(
+            (start, min(start + range_size, records)) for start in range(0, records, range_size)
+        )
+        # range_id -> {'worker', 'start', 'end', 'progress'}
+        self._assigned = {}
+        self._workers = {}
+        self._next_range_id = 0
+        self.completed_users = 0
+        self.counters = defaultdict(int)
+        self.requeued_ranges = 0
+        self.dead_workers = 0
+        self._finished = threading.Event()
+        self._started_at = None
+        # Serializes rate broadcasts so workers never receive an older rate after a newer one
+        self._rate_lock = threading.Lock()
+
+    # ---- bookkeeping ----
+
+    def _worker_rate(self):
+        """Split the global rate budget evenly across live workers."""
+        if not self.rate:
+            return None
+        return self.rate / max(1, len(self._workers))
+
+    def _next_assignment(self, worker_id):
+        with self._lock:
+            if not self._pending:
+                return None
+            start, end = self._pending.popleft()
+            range_id = self._next_range_id
+            self._next_range_id += 1
+            self._assigned[range_id] = {'worker': worker_id, 'start': start, 'end': end, 'progress': 0}
+            return {'type': 'work', 'range_id': range_id, 'start': start, 'end': end, 'run_id': self.run_id}
+
+    def _broadcast_rate(self):
+        """Push the current per-worker share of the rate budget to every live worker."""
+        if not self.rate:
+            return
+        with self._rate_lock:
+            with self._lock:
+                rate = self._worker_rate()
+                targets = [(w['conn'], w['send_lock']) for w in self._workers.values()]
+            for conn, send_lock in targets:
+                try:
+                    with send_lock:
+                        conn.send({'type': 'rate', 'rate': rate})
+                except (OSError, ValueError):
+                    # A dead connection is picked up by its handler or the watchdog
+                    pass
+        if targets:
+            logger.info(f"Rate rebalanced: {len(targets)} workers at {rate:.1f} users/s each")
+
+    def _merge_counters(self, worker_id, counters):
+        """Replace a worker's last reported counters; totals are recomputed from all workers."""
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker is not None:
+                worker['counters'] = counters
+                worker['last_seen'] = time.monotonic()
+
+    def _mark_dead(self, worker_id, reason):
+        with self._lock:
+            worker = self._workers.pop(worker_id, None)
+            if worker is None:
+                return
+            self.dead_workers += 1
+            # Keep what the dead worker already reported
+            for key, value in worker['counters'].items():
+                self.counters[key] += value
+            for range_id, assignment in list(self._assigned.items()):
+                if assignment['worker'] != worker_id:
+                    continue
+                del self._assigned[range_id]
+                resume_at = assignment['start'] + assignment['progress']
+                if resume_at < assignment['end']:
+                    self._pending.appendleft((resume_at, assignment['end']))
+                    self.requeued_ranges += 1
+                    self.completed_users += assignment['progress']
+                else:
+                    self.completed_users += assignment['end'] - assignment['start']
+            conn = worker['conn']
+        logger.warning(f"Worker {worker_id} lost ({reason}); requeued its unfinished work, "
+                       f"{len(self._workers)} workers remain")
+        try:
+            conn.close()
+        except OSError:
+            pass
+        self._broadcast_rate()
+        self._check_finished()
+
+    def _check_finished(self):
+        with self._lock:
+            if not self._pending and not self._assigned:
+                self._finished.set()
+
+    # ---- connection handling ----
+
+    def _handle(self, conn):
+        worker_id = None
+        # Rate broadcasts from other threads share this connection with the replies below
+        send_lock = threading.Lock()
+        try:
+            hello = conn.recv()
+            worker_id = hello['worker_id']
+            with self._lock:
+                self._workers[worker_id] = {
+                    'conn': conn, 'send_lock': send_lock, 'host': hello.get('host'), 'pid': hello.get('pid'),
+                    'last_seen': time.monotonic(), 'counters': {},
+                }
+                if self._started_at is None:
+                    self._started_at = time.monotonic()
+            logger.info(f"Worker {worker_id} joined from {hello.get('host')} (pid {hello.get('pid')}); "
+                        f"{len(self._workers)} workers, {self._worker_rate() or 'unlimited'} users/s each")
+            self._broadcast_rate()
+
+            while True:
+                message = conn.recv()
+                kind = message['type']
+                if kind == 'request':
+                    assignment = self._next_assignment(worker_id)
+                    with send_lock:
+                        conn.send(assignment or {'type': 'done'})
+                elif kind == 'heartbeat':
+                    with self._lock:
+                        assignment = self._assigned.get(message.get('range_id'))
+                        if assignment is not None and assignment['worker'] == worker_id:
+                            assignment['progress'] = message['progress']
+                    self._merge_counters(worker_id, message['counters'])
+                elif kind == 'complete':
+                    with self._lock:
+                        assignment = self._assigned.pop(message['range_id'], None)
+                        if assignment is not None and assignment['worker'] == worker_id:
+                            self.completed_users += assignment['end'] - assignment['start']
+                    self._merge_counters(worker_id, message['counters'])
+                    self._check_finished()
+                elif kind == 'goodbye':
+                    self._merge_counters(worker_id, message['counters'])
+                    with self._lock:
+                        worker = self._workers.pop(worker_id, None)
+                        if worker is not None:
+                            for key, value in worker['counters'].items():
+                                self.counters[key] += value
+                    logger.info(f"Worker {worker_id} finished")
+                    self._broadcast_rate()
+                    return
+        except (EOFError, OSError) as e:
+            if worker_id is not None:
+                self._mark_dead(worker_id, f"connection closed: {e.__class__.__name__}")
+
+    def _watchdog(self):
+        while not self._finished.is_set():
+            time.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            with self._lock:
+                stale = [wid for wid, w in self._workers.items()
+                         if now - w['last_seen'] > self.heartbeat_timeout]
+            for worker_id in stale:
+                self._mark_dead(worker_id, f"no heartbeat for {self.heartbeat_timeout}s")
+
+    def _report(self):
+        while not self._finished.wait(timeout=5.0):
+            with self._lock:
+                live = {wid: w['counters'].get('users', 0) for wid, w in self._workers.items()}
+                in_flight = sum(a['progress'] for a in self._assigned.values())
+                done = self.completed_users + in_flight
+                elapsed = time.monotonic() - self._started_at if self._started_at else 0
+            if elapsed:
+                logger.info(f"Progress: {done}/{self.records} users "
+                            f"({done / elapsed:.0f} users/s, {len(live)} workers)")
+
+    def serve(self):
+        """Run until every range is complete, then return aggregate counters."""
+        listener = Listener(parse_address(self.address), authkey=get_authkey(self.address))
+        logger.info(f"Coordinator {self.run_id} listening on {self.address} for {self.records} users")
+
+        def accept_loop():
+            while not self._finished.is_set():
+                try:
+                    conn = listener.accept()
+                except AuthenticationError as e:
+                    # A peer with the wrong key must not stop later workers from joining
+                    logger.warning(f"Rejected connection with a failed authkey handshake: {e}")
+                    continue
+                except (OSError, EOFError):
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=accept_loop, daemon=True).start()
+        threading.Thread(target=self._watchdog, daemon=True).start()
+        threading.Thread(target=self._report, daemon=True).start()
+        if not self.records:
+            self._finished.set()
+        self._finished.wait()
+
+        # Give connected workers a moment to pick up 'done' and report their final counters
+        deadline = time.monotonic() + self.heartbeat_timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._workers:
+                    break
+            time.sleep(0.1)
+        with self._lock:
+            for worker in self._workers.values():
+                for key, value in worker['counters'].items():
+                    self.counters[key] += value
+            self._workers.clear()
+        listener.close()
+
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        logger.info(f"Run {self.run_id} complete: {self.completed_users} users in {elapsed:.1f}s "
+                    f"({self.completed_users / elapsed if elapsed else 0:.0f} users/s), "
+                    f"{self.dead_workers} workers lost, {self.requeued_ranges} ranges requeued")
+        logger.info(f"Events: {dict(self.counters)}")
+        return dict(self.counters)
+
+
+class Worker:
+    """Pulls user-key ranges from a coordinator and runs journeys for them."""
+
+    def __init__(self, address, ld_client, mode='launchdarkly', assignment_log_path=None,
+                 flag_evaluation='per-flag', metric_sink=None):
+        self.address = address
+        self.ld_client = ld_client
+        self.mode = mode
+        self.assignment_log_path = assignment_log_path
+        self.flag_evaluation = flag_evaluation
+        # Called with each Snowflake metric event (e.g. MetricEventSpool.append) in snowflake mode
+        self.metric_sink = metric_sink
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.counters = defaultdict(int)
+        self._send_lock = threading.Lock()
+        self._replies = queue.Queue()
+        # Per-worker users/s from the coordinator's latest rate message (None = unlimited)
+        self._rate = None
+        self._current = None
+        self._stop = threading.Event()
+
+    def _send(self, conn, message):
+        with self._send_lock:
+            conn.send(message)
+
+    def _heartbeat_loop(self, conn):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            current = self._current
+            try:
+                self._send(conn, {
+                    'type': 'heartbeat',
+                    'range_id': current[0] if current else None,
+                    'progress': current[1] if current else 0,
+                    'counters': dict(self.counters),
+                })
+            except (OSError, ValueError):
+                return
+
+    def _receive_loop(self, conn):
+        """Apply rate updates as they arrive and queue every other message for run()."""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                self._replies.put(None)
+                return
+            if message['type'] == 'rate':
+                if message['rate'] != self._rate:
+                    logger.info(f"Rate updated to {message['rate']:.1f} users/s")
+                self._rate = message['rate']
+            else:
+                self._replies.put(message)
+
+    def run(self):
+        conn = Client(parse_address(self.address), authkey=get_authkey(self.address))
+        self._send(conn, {'type': 'hello', 'worker_id': self.worker_id,
+                          'host': socket.gethostname(), 'pid': os.getpid()})
+        threading.Thread(target=self._receive_loop, args=(conn,), daemon=True).start()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, args=(conn,), daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                # Work replies only ever answer a request, so they arrive in order on the queue
+                self._send(conn, {'type': 'request'})
+                work = self._replies.get()
+                if work is None:
+                    raise EOFError("coordinator closed the connection")
+                if work['type'] == 'done':
+                    break
+                self._run_range(work)
+                self._send(conn, {'type': 'complete', 'range_id': work['range_id'],
+                                  'counters': dict(self.counters)})
+            self._send(conn, {'type': 'goodbye', 'counters': dict(self.counters)})
+        except (EOFError, OSError) as e:
+            logger.error(f"Lost connection to coordinator: {e}")
+            return 1
+        finally:
+            self._stop.set()
+            conn.close()
+        logger.info(f"Worker {self.worker_id} done: {dict(self.counters)}")
+        return 0
+
+    def _run_range(self, work):
+        range_id, start, end = work['range_id'], work['start'], work['end']
+        next_at = time.monotonic()
+        for index in range(start, end):
+            self._current = (range_id, index - start)
+            # Re-read each user so a rebalanced rate applies mid-range
+            rate = self._rate
+            if rate:
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at = max(next_at, time.monotonic() - 1.0) + 1.0 / rate
+            try:
+                user_info, flag_values, events, snowflake_events = simulate_user_journey_v2(
+                    self.ld_client, None, mode=self.mode,
+                    assignment_log_path=self.assignment_log_path,
+                    flag_evaluation=self.flag_evaluation,
+                    context_key=f"{work['run_id']}-{index}"
+                )
+            except Exception as e:
+                self.counters['errors'] += 1
+                logger.error(f"Journey failed for user index {index}: {e}")
+                continue
+            self.counters['users'] += 1
+            for event in events:
+                self.counters[event] += 1
+            if self.metric_sink is not None:
+                for event_data in snowflake_events:
+                    self.metric_sink(event_data)
+                self.counters['snowflake_events'] += len(snowflake_events)
+        self._current = (range_id, end - start)
+
+
+def build_ld_client(offline):
+    """Create the flag client a worker uses: LaunchDarkly, or an offline weighted stand-in."""
+    if offline:
+        from monte_carlo import OfflineFlagClient
+        return OfflineFlagClient({'Control': 1, 'Variant 1': 1, 'Next Generation': 1}, {7: 1})
+    from ldclient.client import LDClient
+    from ldclient.config import Config
+    sdk_key = os.getenv('LAUNCHDARKLY_SDK_KEY')
+    if not sdk_key:
+        raise ValueError("LAUNCHDARKLY_SDK_KEY environment variable is not set")
+    client = LDClient(Config(sdk_key))
+    if not client.is_initialized():
+        raise RuntimeError("LaunchDarkly client failed to initialize")
+    return client
+
+
+def claim_spool_dir(base):
+    """
+    Return (path, lock_file) for the first worker-<host>-<slot> spool directory under base
+    that no other worker on this host holds. Slots are stable, so a restarted worker
+    replays whatever its predecessor left undelivered.
+    """
+    import fcntl
+    host = socket.gethostname()
+    for slot in itertools.count():
+        path = os.path.join(base, f"worker-{host}-{slot}")
+        os.makedirs(path, exist_ok=True)
+        lock_file = open(os.path.join(path, '.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return path, lock_file
+
+
+def run_worker(address, offline=False, mode='launchdarkly', flag_evaluation='per-flag',
+               spool_dir='metric_spool', spool_drain_timeout=30.0, spool_max_attempts=3):
+    snowflake_conn = None
+    spool = None
+    metric_sink = None
+    if mode == 'snowflake':
+        from gravityfarms_simulation import (
+            is_snowflake_available, get_snowflake_connection, insert_metric_event_to_snowflake,
+            is_permanent_snowflake_error
+        )
+        from metric_spool import MetricEventSpool
+        if not is_snowflake_available():
+            logger.error("Snowflake mode selected but snowflake-connector-python is not installed.")
+            return 1
+        snowflake_conn = get_snowflake_connection()
+        worker_spool_dir, _spool_lock = claim_spool_dir(spool_dir)
+        # Same delivery path as the single-process run: spool to disk, insert from the drain worker
+        spool = MetricEventSpool(
+            worker_spool_dir, lambda event_data: insert_metric_event_to_snowflake(snowflake_conn, event_data),
+            max_attempts=spool_max_attempts, permanent_error=is_permanent_snowflake_error
+        )
+        metric_sink = spool.append
+        logger.info(f"Spooling metric events to {worker_spool_dir}")
+
+    ld_client = build_ld_client(offline)
+    worker = Worker(
+        address, ld_client, mode=mode, flag_evaluation=flag_evaluation, metric_sink=metric_sink,
+        assignment_log_path=None if offline else f"experiment_assignments.{socket.gethostname()}-{os.getpid()}.jsonl"
+    )
+    try:
+        return worker.run()
+    finally:
+        if hasattr(ld_client, 'close'):
+            ld_client.close()
+        if spool:
+            spool.close(drain_timeout=spool_drain_timeout)
+            logger.info(f"Metric event spool closed: {spool.stats()}")
+        if snowflake_conn:
+            snowflake_conn.close()
+
+
+def run_local(workers, records, range_size, rate, offline, kill_worker_after=None):
+    """Run a coordinator plus several worker processes on localhost."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        address = f"127.0.0.1:{s.getsockname()[1]}"
+    coordinator = Coordinator(address, records, range_size=range_size, rate=rate)
+    result = {}
+    server = threading.Thread(target=lambda: result.update(coordinator.serve()), daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    cmd = [sys.executable, os.path.abspath(__file__), 'worker', '--connect', address]
+    if offline:
+        cmd.append('--offline')
+    procs = [subprocess.Popen(cmd) for _ in range(workers)]
+    if kill_worker_after:
+        time.sleep(kill_worker_after)
+        logger.info(f"Killing worker pid {procs[0].pid} to exercise rebalancing")
+        procs[0].kill()
+    server.join()
+    for proc in procs:
+        proc.wait(timeout=30)
+    return 0 if coordinator.completed_users >= records else 1
+
+
+def main(argv=None):
+    configure_logging()
+    parser = argparse.ArgumentParser(description='Distributed Gravity Farms load generation')
+    sub = parser.add_subparsers(dest='role', required=True)
+
+    coord = sub.add_parser('coordinator', help='Hand out user ranges and aggregate results')
+    coord.add_argument('--bind', default=DEFAULT_ADDRESS, help='host:port to listen on')
+    coord.add_argument('--records', type=int, default=10000, help='Total users to simulate')
+    coord.add_argument('--range-size', type=int, default=500, help='Users per work range')
+    coord.add_argument('--rate', type=float, help='Cluster-wide users/second budget (default: unlimited)')
+    coord.add_argument('--heartbeat-timeout', type=float, default=5.0, help='Seconds before a silent worker is declared dead')
+
+    work = sub.add_parser('worker', help='Pull ranges from a coordinator and run journeys')
+    work.add_argument('--connect', default=DEFAULT_ADDRESS, help='Coordinator host:port')
+    work.add_argument('--offline', action='store_true', help='Use an offline weighted flag client instead of LaunchDarkly')
+    work.add_argument('--mode', choices=['launchdarkly', 'snowflake'], default='launchdarkly', help='Journey mode')
+    work.add_argument('--flag-evaluation', choices=['per-flag', 'snapshot'], default='per-flag')
+    work.add_argument('--spool-dir', default='metric_spool', help='Base directory for per-worker Snowflake metric spools')
+    work.add_argument('--spool-drain-timeout', type=float, default=30.0, help='Seconds to wait for the spool to drain before exiting')
+    work.add_argument('--spool-max-attempts', type=int, default=3, help='Attempts before a metric event failing with a non-retryable error is moved to the spool dead-letter file')
+
+    local = sub.add_parser('local', help='Coordinator and N worker processes on localhost')
+    local.add_argument('--workers', type=int, default=4)
+    local.add_argument('--records', type=int, default=20000)
+    local.add_argument('--range-size', type=int, default=500)
+    local.add_argument('--rate', type=float)
+    local.add_argument('--offline', action='store_true')
+    local.add_argument('--kill-worker-after', type=float, help='Kill one worker after this many seconds')
+
+    args = parser.parse_args(argv)
+    try:
+        if args.role == 'coordinator':
+            Coordinator(args.bind, args.records, range_size=args.range_size, rate=args.rate,
+                        heartbeat_timeout=args.heartbeat_timeout).serve()
+            return 0
+        if args.role == 'worker':
+            from dotenv import load_dotenv
+            load_dotenv()
+            return run_worker(args.connect, offline=args.offline, mode=args.mode,
+                              flag_evaluation=args.flag_evaluation, spool_dir=args.spool_dir,
+                              spool_drain_timeout=args.spool_drain_timeout,
+                              spool_max_attempts=args.spool_max_attempts)
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    return run_local(args.workers, args.records, args.range_size, args.rate, args.offline,
+                     kill_worker_after=args.kill_worker_after)
+
+
+if __name__ == "__main__":
+    exit(main())
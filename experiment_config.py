@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Hot-reloadable experiment and population configuration.
+
+Loads the user generation lists and the journey funnel from a JSON file
+(experiment_config.json), validates them, and compiles them into tuples and
+a funnel_engine.FunnelModel. The "funnel" section is merged over
+gravityfarms_simulation.HERO_BANNER_FUNNEL, so it only needs the keys it
+changes; every conversion rate and revenue distribution the journeys use
+lives there (per variant, per region or both).
+
+ConfigWatcher polls the file's mtime on a background thread. A changed file
+is loaded, validated and compiled off the journey loop, then published with
+a single reference swap; journeys pick up the new CompiledConfig at their
+next acquire(), so generation never pauses. Invalid files are logged and the
+current config stays in place.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from funnel_engine import compile_funnel, FunnelDefinitionError
+
+logger = logging.getLogger('gravityfarms-config')
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'experiment_config.json')
+
+USER_GENERATION_KEYS = ('countries', 'petTypes', 'planTypes', 'paymentTypes')
+TOP_LEVEL_KEYS = ('version', 'userGeneration', 'funnel')
+
+
+class ConfigError(ValueError):
+    """Raised when an experiment config file is malformed."""
+
+
+def validate_config(raw):
+    """Check the structure of a raw config dict; raises ConfigError listing every problem."""
+    errors = []
+    if not isinstance(raw, dict):
+        raise ConfigError("config must be a JSON object")
+
+    for key in raw:
+        if key not in TOP_LEVEL_KEYS:
+            # Catches sections nothing reads (e.g. the old experiments/randomness tables)
+            errors.append(f"{key}: unknown section (expected {', '.join(TOP_LEVEL_KEYS)}; rates go in funnel)")
+
+    generation = raw.get('userGeneration')
+    if not isinstance(generation, dict):
+        errors.append("userGeneration: expected an object")
+        generation = {}
+    for key in USER_GENERATION_KEYS:
+        values = generation.get(key)
+        if not isinstance(values, list) or not values or not all(isinstance(v, str) for v in values):
+            errors.append(f"userGeneration.{key}: expected a non-empty list of strings")
+
+    if 'funnel' in raw and not isinstance(raw['funnel'], dict):
+        errors.append("funnel: expected an object")
+
+    if errors:
+        raise ConfigError("; ".join(errors))
+
+
+class CompiledConfig:
+    """Immutable lookup tables built from one version of the config file."""
+
+    def __init__(self, raw, version, source_mtime=None):
+        from gravityfarms_simulation import HERO_BANNER_FUNNEL
+
+        self.version = version
+        self.source_mtime = source_mtime
+        self.compiled_at = time.time()
+        self.first_used_at = None
+        self.swap_latency_ms = None
+
+        generation = raw['userGeneration']
+        self.countries = tuple(generation['countries'])
+        self.pet_types = tuple(generation['petTypes'])
+        self.plan_types = tuple(generation['planTypes'])
+        self.payment_types = tuple(generation['paymentTypes'])
+
+        try:
+            self.funnel_model = compile_funnel({**HERO_BANNER_FUNNEL, **raw.get('funnel', {})})
+        except (FunnelDefinitionError, KeyError, TypeError) as e:
+            raise ConfigError(f"funnel: {e}") from None
+
+    def event_data(self):
+        """Config provenance attached to tracked events."""
+        return {'configVersion': self.version, 'configSwapLatencyMs': self.swap_latency_ms}
+
+
+def load_config(path=DEFAULT_CONFIG_PATH):
+    """Load, validate and compile the config at path."""
+    with open(path, 'rb') as f:
+        content = f.read()
+    mtime = os.stat(path).st_mtime
+    try:
+        raw = json.loads(content)
+    except ValueError as e:
+        raise ConfigError(f"{path}: invalid JSON ({e})") from None
+    validate_config(raw)
+    digest = hashlib.sha256(content).hexdigest()[:8]
+    version = f"{raw['version']}-{digest}" if 'version' in raw else digest
+    return CompiledConfig(raw, version, source_mtime=mtime)
+
+
+class ConfigWatcher(threading.Thread):
+    """Polls a config file and atomically swaps in a newly compiled config when it changes."""
+
+    def __init__(self, path=DEFAULT_CONFIG_PATH, interval=1.0):
+        super().__init__(name='config-watcher', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.swaps = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._current = load_config(path)
+        self._current.first_used_at = self._current.compiled_at
+        self._last_signature = self._signature()
+
+    def acquire(self):
+        """Return the config to use for the next journey, recording swap latency on first use."""
+        config = self._current
+        if config.first_used_at is None:
+            with self._lock:
+                if config.first_used_at is None:
+                    now = time.time()
+                    # Latency from the file being written to the first journey running on it
+                    config.swap_latency_ms = (now - config.source_mtime) * 1000
+                    config.first_used_at = now
+                    logger.info(f"Config {config.version} in effect {config.swap_latency_ms:.0f} ms after the file changed")
+        return config
+
+    def check(self):
+        """Reload the file if its mtime changed; returns True when a new config was published."""
+        try:
+            signature = self._signature()
+        except OSError as e:
+            logger.warning(f"Cannot stat config {self.path}: {e}")
+            return False
+        if signature == self._last_signature:
+            return False
+        self._last_signature = signature
+        try:
+            config = load_config(self.path)
+        except (OSError, ConfigError) as e:
+            self.rejected += 1
+            logger.error(f"Rejected config change, keeping {self._current.version}: {e}")
+            return False
+        if config.version == self._current.version:
+            return False
+        # A single reference assignment: journeys see either the old or the new config, never a mix
+        self._current = config
+        self.swaps += 1
+        logger.info(f"Compiled config {config.version}; it applies from the next journey")
+        return True
+
+    def _signature(self):
+        # mtime alone can miss a rewrite landing in the same filesystem timestamp tick as a partial write
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._stop_event.set()
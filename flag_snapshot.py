@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Single-call flag evaluation snapshots.
+
+Evaluates every flag for a context with one all_flags_state(context,
+with_reasons=True) call and exposes the results through the same
+value / variation_index / reason shape as variation_detail(), so journey
+logic and the assignment log can read any flag from one snapshot.
+
+Note: all_flags_state() does not emit per-flag evaluation events, so
+LaunchDarkly will not record experiment exposures for snapshot-evaluated
+users. Use it where assignments are attributed from the local assignment
+log (e.g. Snowflake mode) rather than from LaunchDarkly's own analysis.
+
+Run this module directly to benchmark snapshots against per-flag calls:
+
+    python flag_snapshot.py --flag-counts 3,10,50,200 --users 2000
+"""
+
+import time
+import argparse
+from collections import namedtuple
+
+FlagDetail = namedtuple('FlagDetail', ['value', 'variation_index', 'reason'])
+
+
+class FlagSnapshot:
+    """Per-user values, variation indexes and reasons for every flag."""
+
+    __slots__ = ('valid', 'flags')
+
+    def __init__(self, valid, flags):
+        self.valid = valid
+        self.flags = flags
+
+    @classmethod
+    def from_state(cls, state):
+        """Build a snapshot from an ldclient FeatureFlagsState."""
+        if not state.valid:
+            return cls(False, {})
+        metadata = state.to_json_dict().get('$flagsState', {})
+        flags = {}
+        for key, value in state.to_values_map().items():
+            meta = metadata.get(key, {})
+            flags[key] = FlagDetail(value, meta.get('variation'), meta.get('reason'))
+        return cls(True, flags)
+
+    def detail(self, key, default=None):
+        """Return a FlagDetail for key, substituting default when the flag fell back to it."""
+        detail = self.flags.get(key)
+        if detail is None:
+            return FlagDetail(default, None, {'kind': 'ERROR', 'errorKind': 'FLAG_NOT_FOUND'})
+        if detail.value is None:
+            return detail._replace(value=default)
+        return detail
+
+    def value(self, key, default=None):
+        return self.detail(key, default).value
+
+    def to_log_dict(self):
+        """Compact {flag: [value, variation_index, reason_kind]} form for the assignment log."""
+        return {
+            key: [d.value, d.variation_index, (d.reason or {}).get('kind')]
+            for key, d in self.flags.items()
+        }
+
+
+def evaluate_flag_snapshot(ld_client, context):
+    """Evaluate all flags for context in a single call."""
+    return FlagSnapshot.from_state(ld_client.all_flags_state(context, with_reasons=True))
+
+
+class CountingEventProcessor:
+    """Event processor that counts events instead of sending them, for offline benchmarks."""
+
+    def __init__(self, config=None):
+        self.count = 0
+
+    def send_event(self, event):
+        self.count += 1
+
+    def flush(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def _offline_client(flag_count):
+    """Build an LDClient backed by TestData with flag_count multi-variation flags."""
+    from ldclient.client import LDClient
+    from ldclient.config import Config
+    from ldclient.integrations.test_data import TestData
+
+    td = TestData.data_source()
+    for n in range(flag_count):
+        td.update(
+            td.flag(f'bench-flag-{n}')
+            .variations('a', 'b', 'c')
+            .fallthrough_variation(n % 3)
+            .if_match('country', 'US').then_return(0)
+        )
+    events = CountingEventProcessor()
+    config = Config(
+        'bench-sdk-key', update_processor_class=td, diagnostic_opt_out=True,
+        event_processor_class=lambda config: events
+    )
+    return LDClient(config=config), events
+
+
+def benchmark(flag_counts, users):
+    """Compare per-flag variation_detail calls with one all_flags_state call as flags grow."""
+    from gravityfarms_simulation import generate_user_context
+
+    contexts = [generate_user_context()[0] for _ in range(users)]
+    print(f"{'Flags':>6} {'per-flag us/user':>17} {'events/user':>12} "
+          f"{'snapshot us/user':>17} {'events/user':>12} {'speedup':>8}")
+    for flag_count in flag_counts:
+        client, events = _offline_client(flag_count)
+        keys = [f'bench-flag-{n}' for n in range(flag_count)]
+        try:
+            start = time.perf_counter()
+            for context in contexts:
+                for key in keys:
+                    client.variation_detail(key, context, None)
+            per_flag = (time.perf_counter() - start) / users
+            per_flag_events = events.count / users
+
+            events.count = 0
+            start = time.perf_counter()
+            for context in contexts:
+                evaluate_flag_snapshot(client, context)
+            snapshot = (time.perf_counter() - start) / users
+            snapshot_events = events.count / users
+        finally:
+            client.close()
+        print(f"{flag_count:>6} {per_flag * 1e6:>17.1f} {per_flag_events:>12.1f} "
+              f"{snapshot * 1e6:>17.1f} {snapshot_events:>12.1f} {per_flag / snapshot:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark all-flags snapshots against per-flag evaluation')
+    parser.add_argument('--flag-counts', default='3,10,50,200', help='Comma-separated flag counts to benchmark')
+    parser.add_argument('--users', type=int, default=2000, help='Contexts evaluated per flag count')
+    args = parser.parse_args()
+    benchmark([int(n) for n in args.flag_counts.split(',')], args.users)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Journey engine driven by a declarative funnel definition.
+
+A funnel definition lists the funnel states, the transition probability
+between them (a constant, or a table keyed by variant and/or region), value
+distributions attached to states, and independent side events. It is
+compiled once into cumulative transition tables for the per-user path and,
+lazily, into NumPy transition matrices of shape
+(variants, regions, states + 1, states + 1) for the vectorized path; the
+extra state is the absorbing exit.
+
+Definition shape:
+
+    {
+        "start": "page_view",
+        "variants": ["Control", ...],
+        "regions": ["US", "UK", "EU", "CA"],
+        "region_map": {"FR": "EU", "DE": "EU"},
+        "prices": {"basic": {"US": 29.99, ...}, ...},
+        "transitions": {
+            "page_view": {"trial_signup": {"by": "variant", "rates": {"Control": 0.05, ...}}},
+            "trial_signup": {"trial_to_paid_conversion": 0.5},
+        },
+        "values": {
+            "trial_to_paid_conversion": [
+                {"event": "total_revenue", "dist": "normal", "mean": {"by": "variant", "rates": {...}},
+                 "stddev": 5.0, "round": 2, "min": 0},
+                {"event": "adjusted_revenue", "dist": "trial_adjusted", "of": "total_revenue",
+                 "round": 2, "min": 0},
+            ]
+        },
+        "side_events": [
+            {"event": "banner_click", "rate": 0.1, "requires": "seasonal_banner"},
+            {"event": "hero_engagement", "rate": 0.15},
+        ],
+    }
+
+Rates may be keyed "by": "variant", "region" or "variant_region" (nested
+{variant: {region: rate}}). Transitions must not form a cycle, and each value
+needs the key its dist reads: "mean" (normal), "value" (fixed) or "of"
+(trial_adjusted, naming another value event); "round" must be an integer.
+"""
+
+import random
+
+
+class FunnelDefinitionError(ValueError):
+    """Raised when a funnel definition is malformed."""
+
+
+def _find_cycle(transitions):
+    """Return a list of states forming a cycle in the transition graph, or None."""
+    visiting, done = [], set()
+
+    def visit(state):
+        if state in done:
+            return None
+        if state in visiting:
+            return visiting[visiting.index(state):] + [state]
+        visiting.append(state)
+        for target in transitions.get(state, {}):
+            cycle = visit(target)
+            if cycle:
+                return cycle
+        visiting.pop()
+        done.add(state)
+        return None
+
+    for state in transitions:
+        cycle = visit(state)
+        if cycle:
+            return cycle
+    return None
+
+
+def _check_value_spec(spec, state):
+    """Reject value specs missing the keys their dist needs, before any user hits them."""
+    if not isinstance(spec, dict) or not isinstance(spec.get('event'), str):
+        raise FunnelDefinitionError(f"values[{state}]: expected {{'event': ..., 'dist': ...}}, got {spec!r}")
+    required = {'normal': 'mean', 'fixed': 'value', 'trial_adjusted': 'of'}.get(spec.get('dist'))
+    if required is None:
+        raise FunnelDefinitionError(f"{spec['event']}: unknown dist {spec.get('dist')!r}")
+    if required not in spec:
+        raise FunnelDefinitionError(f"{spec['event']}: dist {spec['dist']!r} requires {required!r}")
+    if 'round' in spec and (not isinstance(spec['round'], int) or isinstance(spec['round'], bool)):
+        raise FunnelDefinitionError(f"{spec['event']}: 'round' must be an integer, got {spec['round']!r}")
+    for key in ('stddev', 'min'):
+        if key in spec and not isinstance(spec[key], (int, float)):
+            raise FunnelDefinitionError(f"{spec['event']}: {key!r} must be a number, got {spec[key]!r}")
+
+
+def _rate_table(spec, variants, regions, what):
+    """Expand a rate spec into a [variant][region] list of floats."""
+    if isinstance(spec, (int, float)):
+        return [[float(spec)] * len(regions) for _ in variants]
+    if not isinstance(spec, dict) or 'by' not in spec or 'rates' not in spec:
+        raise FunnelDefinitionError(f"{what}: expected a number or {{'by': ..., 'rates': ...}}, got {spec!r}")
+    by, rates = spec['by'], spec['rates']
+    try:
+        if by == 'variant':
+            return [[float(rates[v])] * len(regions) for v in variants]
+        if by == 'region':
+            return [[float(rates[r]) for r in regions] for _ in variants]
+        if by == 'variant_region':
+            return [[float(rates[v][r]) for r in regions] for v in variants]
+    except KeyError as e:
+        raise FunnelDefinitionError(f"{what}: no rate for {e}") from None
+    raise FunnelDefinitionError(f"{what}: unknown 'by' {by!r}")
+
+
+class FunnelModel:
+    """A compiled funnel: per-user sampling plus lazily-built vectorized matrices."""
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.variants = list(definition['variants'])
+        self.regions = list(definition.get('regions', ['default']))
+        self.region_map = dict(definition.get('region_map', {}))
+        self.prices = definition.get('prices', {})
+        self.start = definition['start']
+
+        transitions = definition.get('transitions', {})
+        for source, targets in transitions.items():
+            if not isinstance(targets, dict):
+                raise FunnelDefinitionError(f"transitions[{source}]: expected {{target: rate}}, got {targets!r}")
+        # run_user walks until a state has no way out, so a cycle would never end
+        cycle = _find_cycle(transitions)
+        if cycle:
+            raise FunnelDefinitionError(f"transitions: cycle {' -> '.join(cycle)}")
+        states = [self.start]
+        for source, targets in transitions.items():
+            for state in [source, *targets]:
+                if state not in states:
+                    states.append(state)
+        self.states = states
+        self.exit = len(states)
+        self._state_index = {s: i for i, s in enumerate(states)}
+        self._variant_index = {v: i for i, v in enumerate(self.variants)}
+        self._region_index = {r: i for i, r in enumerate(self.regions)}
+
+        # probs[v][r][from] -> list of (to_index, probability)
+        self._probs = [[[[] for _ in states] for _ in self.regions] for _ in self.variants]
+        for source, targets in transitions.items():
+            i = self._state_index[source]
+            for target, spec in targets.items():
+                table = _rate_table(spec, self.variants, self.regions, f"{source} -> {target}")
+                for v in range(len(self.variants)):
+                    for r in range(len(self.regions)):
+                        self._probs[v][r][i].append((self._state_index[target], table[v][r]))
+        # Per-user path: cumulative thresholds per (variant, region, state)
+        self._cumulative = [[[self._cumulate(row, f"{states[i]} ({self.variants[v]}, {self.regions[r]})")
+                              for i, row in enumerate(by_state)]
+                             for r, by_state in enumerate(by_region)]
+                            for v, by_region in enumerate(self._probs)]
+
+        self._values = {}
+        values = definition.get('values', {})
+        for state, specs in values.items():
+            if state not in self._state_index:
+                raise FunnelDefinitionError(f"values: unknown state {state!r}")
+            if not isinstance(specs, list):
+                raise FunnelDefinitionError(f"values[{state}]: expected a list of value specs, got {specs!r}")
+            for spec in specs:
+                _check_value_spec(spec, state)
+        value_events = {spec['event'] for specs in values.values() for spec in specs}
+        for state, specs in values.items():
+            compiled = []
+            for spec in specs:
+                spec = dict(spec)
+                if spec['dist'] == 'normal':
+                    spec['mean_table'] = _rate_table(spec['mean'], self.variants, self.regions, f"{spec['event']} mean")
+                elif spec['dist'] == 'fixed':
+                    spec['value_table'] = _rate_table(spec['value'], self.variants, self.regions, f"{spec['event']} value")
+                elif spec['of'] not in value_events:
+                    raise FunnelDefinitionError(f"{spec['event']}: 'of' names unknown value event {spec['of']!r}")
+                compiled.append(spec)
+            self._values[state] = compiled
+
+        self._side_events = []
+        for spec in definition.get('side_events', []):
+            if not isinstance(spec, dict) or 'event' not in spec or 'rate' not in spec:
+                raise FunnelDefinitionError(f"side_events: expected {{'event': ..., 'rate': ...}}, got {spec!r}")
+            spec = dict(spec)
+            spec['rate_table'] = _rate_table(spec['rate'], self.variants, self.regions, spec['event'])
+            self._side_events.append(spec)
+
+        self._matrices = None
+
+    @staticmethod
+    def _cumulate(row, what):
+        total = 0.0
+        cumulative = []
+        for target, p in row:
+            if p < 0:
+                raise FunnelDefinitionError(f"{what}: negative probability")
+            total += p
+            cumulative.append((total, target))
+        if total > 1.0 + 1e-9:
+            raise FunnelDefinitionError(f"{what}: outgoing probabilities sum to {total:.4f} > 1")
+        return cumulative
+
+    # ---- lookups ----
+
+    def region_of(self, country):
+        region = self.region_map.get(country, country)
+        return region if region in self._region_index else self.regions[0]
+
+    def monthly_price(self, plan_type, country):
+        """Monthly plan price for a country, falling back to basic / first region."""
+        plans = self.prices
+        if not plans:
+            return 0.0
+        by_region = plans.get(plan_type, plans.get('basic', next(iter(plans.values()))))
+        fallback = plans.get('basic', by_region)
+        region = self.region_map.get(country, country)
+        return by_region.get(region, fallback.get(self.regions[0], 0.0))
+
+    def variant_index(self, variant):
+        return self._variant_index[variant]
+
+    def region_index(self, region):
+        return self._region_index[region]
+
+    # ---- per-user path ----
+
+    def _value(self, spec, v, r, attributes, emitted, rng):
+        dist = spec['dist']
+        if dist == 'normal':
+            value = rng.gauss(spec['mean_table'][v][r], spec.get('stddev', 0.0))
+        elif dist == 'fixed':
+            value = spec['value_table'][v][r]
+        else:
+            base = emitted.get(spec['of'], 0.0)
+            trial_cost = attributes.get('monthly_price', 0.0) / 30 * attributes.get('trial_days', 0)
+            value = base - trial_cost
+        if 'round' in spec:
+            value = round(value, spec['round'])
+        if 'min' in spec:
+            value = max(spec['min'], value)
+        return value
+
+    def run_user(self, variant, region, attributes=None, rng=random):
+        """Walk one user through the funnel; returns [(event_key, value or None)] after the start state."""
+        attributes = attributes or {}
+        v = self._variant_index[variant]
+        r = self._region_index.get(region, 0)
+        outcomes = []
+        emitted = {}
+        state = 0
+        while True:
+            cumulative = self._cumulative[v][r][state]
+            if not cumulative:
+                break
+            u = rng.random()
+            for threshold, target in cumulative:
+                if u < threshold:
+                    state = target
+                    break
+            else:
+                break
+            name = self.states[state]
+            outcomes.append((name, None))
+            for spec in self._values.get(name, ()):
+                value = self._value(spec, v, r, attributes, emitted, rng)
+                emitted[spec['event']] = value
+                outcomes.append((spec['event'], value))
+        for spec in self._side_events:
+            requires = spec.get('requires')
+            if requires and not attributes.get(requires):
+                continue
+            if rng.random() < spec['rate_table'][v][r]:
+                outcomes.append((spec['event'], None))
+        return outcomes
+
+    # ---- vectorized path ----
+
+    def transition_matrices(self):
+        """Return P[variant, region, from, to] including the absorbing exit state (NumPy)."""
+        if self._matrices is None:
+            import numpy as np
+            n = len(self.states) + 1
+            P = np.zeros((len(self.variants), len(self.regions), n, n))
+            for v, by_region in enumerate(self._probs):
+                for r, by_state in enumerate(by_region):
+                    for i, row in enumerate(by_state):
+                        for target, p in row:
+                            P[v, r, i, target] += p
+                        P[v, r, i, self.exit] = max(0.0, 1.0 - P[v, r, i, :self.exit].sum())
+            P[:, :, self.exit, self.exit] = 1.0
+            self._matrices = (P, np.cumsum(P, axis=3))
+        return self._matrices[0]
+
+    def run_batch(self, variant_idx, region_idx, attributes=None, rng=None):
+        """Walk a batch of users through the funnel at once.
+
+        variant_idx and region_idx are integer arrays; attributes maps names
+        to per-user arrays (e.g. 'seasonal_banner', 'monthly_price',
+        'trial_days'). Returns {event_key: (fired bool array, value array or None)}.
+        """
+        import numpy as np
+        rng = rng if rng is not None else np.random.default_rng()
+        attributes = attributes or {}
+        self.transition_matrices()
+        cumulative = self._matrices[1]
+        n = len(variant_idx)
+
+        results = {}
+        emitted = {}
+        state = np.zeros(n, dtype=np.int64)
+        for _ in range(len(self.states)):
+            live = state != self.exit
+            if not live.any():
+                break
+            u = rng.random(n)
+            cum = cumulative[variant_idx, region_idx, state]
+            next_state = np.minimum((cum <= u[:, None]).sum(axis=1), self.exit)
+            next_state[~live] = self.exit
+            state = next_state
+            for i, name in enumerate(self.states):
+                entered = state == i
+                if not entered.any():
+                    continue
+                fired = results.get(name, (np.zeros(n, dtype=bool), None))[0] | entered
+                results[name] = (fired, None)
+                for spec in self._values.get(name, ()):
+                    values = self._batch_value(spec, variant_idx, region_idx, attributes, emitted, n, rng)
+                    previous = results.get(spec['event'])
+                    merged = np.where(entered, values, previous[1] if previous else 0.0)
+                    results[spec['event']] = (fired, merged)
+                    emitted[spec['event']] = merged
+        for spec in self._side_events:
+            table = np.array(spec['rate_table'])
+            fired = rng.random(n) < table[variant_idx, region_idx]
+            requires = spec.get('requires')
+            if requires:
+                fired &= np.asarray(attributes.get(requires, np.zeros(n, dtype=bool)), dtype=bool)
+            results[spec['event']] = (fired, None)
+        for name in self.states[1:]:
+            results.setdefault(name, (np.zeros(n, dtype=bool), None))
+        return results
+
+    def _batch_value(self, spec, variant_idx, region_idx, attributes, emitted, n, rng):
+        import numpy as np
+        dist = spec['dist']
+        if dist == 'normal':
+            mean = np.array(spec['mean_table'])[variant_idx, region_idx]
+            values = rng.normal(mean, spec.get('stddev', 0.0))
+        elif dist == 'fixed':
+            values = np.array(spec['value_table'], dtype=float)[variant_idx, region_idx]
+        else:
+            base = emitted.get(spec['of'], np.zeros(n))
+            price = np.asarray(attributes.get('monthly_price', np.zeros(n)), dtype=float)
+            trial_days = np.asarray(attributes.get('trial_days', np.zeros(n)), dtype=float)
+            values = base - price / 30 * trial_days
+        if 'round' in spec:
+            values = np.round(values, spec['round'])
+        if 'min' in spec:
+            values = np.maximum(spec['min'], values)
+        return values
+
+
+def compile_funnel(definition):
+    """Validate a funnel definition and compile it into a FunnelModel."""
+    for key in ('start', 'variants'):
+        if key not in definition:
+            raise FunnelDefinitionError(f"funnel definition is missing {key!r}")
+    return FunnelModel(definition)
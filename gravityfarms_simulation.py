@@ -8,46 +8,117 @@ Supports both LaunchDarkly SDK tracking and Snowflake data insertion.
 """
 
 import os
+import sys
 import time
 import uuid
 import json
 import random
 import argparse
 import logging
+import threading
+import importlib.util
 from datetime import datetime, timedelta, timezone
-from faker import Faker
-import ldclient
-from ldclient.config import Config
-from ldclient.context import Context
-from dotenv import load_dotenv
-load_dotenv()
-
-# Optional Snowflake import
-try:
-    import snowflake.connector
-    SNOWFLAKE_AVAILABLE = True
-except ImportError:
-    SNOWFLAKE_AVAILABLE = False
-    print("Warning: snowflake-connector-python not installed. Snowflake mode will not be available.")
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from metric_spool import MetricEventSpool
+from metric_rollup import MetricRollupSink
+from sequential_testing import SequentialMonitor
+from flag_snapshot import evaluate_flag_snapshot
+from funnel_engine import compile_funnel
+from stage_profiler import SimulationProfiler, add_profile_arguments
+
+# Heavy dependencies (ldclient, Faker, snowflake-connector-python) are imported on
+# first use so that importing this module for its helpers stays cheap.
+
 logger = logging.getLogger('gravityfarms-simulation')
 
-fake = Faker()
+_fake = None
+
+def configure_logging(level=logging.INFO):
+    """Configure root logging for command-line entry points."""
+    logging.basicConfig(
+        level=level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+def get_faker():
+    """Return the shared Faker instance, constructing it on first use."""
+    global _fake
+    if _fake is None:
+        from faker import Faker
+        _fake = Faker()
+    return _fake
+
+def is_snowflake_available():
+    """Check whether snowflake-connector-python is installed without importing it."""
+    return importlib.util.find_spec('snowflake') is not None and \
+        importlib.util.find_spec('snowflake.connector') is not None
 
 COUNTRIES = ["US", "UK", "FR", "DE", "CA"]
 PET_TYPES = ["dog", "cat", "both"]
 PLAN_TYPES = ["basic", "premium", "trial"]
 PAYMENT_TYPES = ["credit_card", "paypal", "apple_pay", "google_pay", "bank"]
 
+# Monthly plan prices by region, used for revenue and trial cost
+BASE_PRICES = {
+    "basic": {"US": 29.99, "CA": 39.99, "UK": 24.99, "EU": 27.99},
+    "premium": {"US": 49.99, "CA": 64.99, "UK": 39.99, "EU": 44.99},
+    "deluxe": {"US": 79.99, "CA": 99.99, "UK": 59.99, "EU": 66.99}
+}
+
+# Hero banner experiment funnel
+VARIANT_CONVERSION_RATE = {
+    "Control": 0.05,
+    "Variant 1": 0.07,
+    "Next Generation": 0.09
+}
+VARIANT_REVENUE_MEAN = {
+    "Control": 30.0,
+    "Variant 1": 35.0,
+    "Next Generation": 40.0
+}
+REVENUE_STDDEV = 5.0
+PAID_CONVERSION_RATE = 0.5
+BANNER_CLICK_RATE = 0.1
+HERO_ENGAGEMENT_RATE = 0.15
+
+# Declarative form of the hero banner funnel, shared by every journey entry point
+HERO_BANNER_FUNNEL = {
+    "start": "page_view",
+    "variants": list(VARIANT_CONVERSION_RATE),
+    "regions": ["US", "UK", "EU", "CA"],
+    "region_map": {"FR": "EU", "DE": "EU"},
+    "prices": BASE_PRICES,
+    "transitions": {
+        "page_view": {"trial_signup": {"by": "variant", "rates": VARIANT_CONVERSION_RATE}},
+        "trial_signup": {"trial_to_paid_conversion": PAID_CONVERSION_RATE},
+    },
+    "values": {
+        "trial_to_paid_conversion": [
+            {"event": "total_revenue", "dist": "normal", "mean": {"by": "variant", "rates": VARIANT_REVENUE_MEAN},
+             "stddev": REVENUE_STDDEV, "round": 2, "min": 0},
+            {"event": "adjusted_revenue", "dist": "trial_adjusted", "of": "total_revenue", "round": 2, "min": 0},
+        ]
+    },
+    "side_events": [
+        {"event": "banner_click", "rate": BANNER_CLICK_RATE, "requires": "seasonal_banner"},
+        {"event": "hero_engagement", "rate": HERO_ENGAGEMENT_RATE},
+    ],
+}
+HERO_BANNER_MODEL = compile_funnel(HERO_BANNER_FUNNEL)
+
+# Module functions timed as per-user stages under --profile
+PROFILE_STAGES = {
+    "generate_user_context": "generate_user_context",
+    "generate_metric_event_data": "generate_metric_event_data",
+    "write_assignment_log": "sink_write",
+    "insert_metric_event_to_snowflake": "sink_delivery",
+    "insert_metric_rollup_to_snowflake": "sink_delivery",
+}
+
 def get_snowflake_connection():
     """Create and return a Snowflake connection."""
-    if not SNOWFLAKE_AVAILABLE:
+    if not is_snowflake_available():
         raise ImportError("snowflake-connector-python is not installed")
+    import snowflake.connector
     
     # Get Snowflake connection parameters from environment
     account = os.getenv('SNOWFLAKE_ACCOUNT')
@@ -120,14 +191,59 @@ def insert_metric_event_to_snowflake(conn, event_data):
     finally:
         cursor.close()
 
-def generate_metric_event_data(user_key, event_key, event_value=None, flag_eval_time=None):
+def is_permanent_snowflake_error(error):
+    """True for insert failures retrying cannot fix (bad SQL or data, missing config), not outages."""
+    if isinstance(error, (KeyError, TypeError, ValueError)):
+        return True
+    # By class name so classifying does not import snowflake.connector; OperationalError,
+    # InterfaceError and network errors stay retryable
+    return type(error).__name__ in ('ProgrammingError', 'DataError', 'IntegrityError', 'NotSupportedError')
+
+def insert_metric_rollup_to_snowflake(conn, rollup_row):
+    """Insert a pre-aggregated metric rollup row into Snowflake."""
+    table_name = os.getenv('SNOWFLAKE_METRIC_ROLLUPS_TABLE')
+    if not table_name:
+        raise ValueError("SNOWFLAKE_METRIC_ROLLUPS_TABLE environment variable is required")
+    
+    cursor = conn.cursor()
+    
+    insert_sql = f"""
+    INSERT INTO {table_name} (
+        ROLLUP_ID, BUCKET_START, BUCKET_SECONDS, FLAG_KEY, VARIATION, EVENT_KEY,
+        EVENT_COUNT, VALUE_COUNT, VALUE_SUM, VALUE_SUM_SQ
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    
+    try:
+        cursor.execute(insert_sql, (
+            rollup_row['rollup_id'],
+            rollup_row['bucket_start'],
+            rollup_row['bucket_seconds'],
+            rollup_row['flag_key'],
+            rollup_row['variation'],
+            rollup_row['event_key'],
+            rollup_row['event_count'],
+            rollup_row['value_count'],
+            rollup_row['value_sum'],
+            rollup_row['value_sum_sq']
+        ))
+        conn.commit()
+        logger.debug(f"Inserted rollup row: {rollup_row['event_key']} {rollup_row['variation']} @ {rollup_row['bucket_start']}")
+    except Exception as e:
+        logger.error(f"Error inserting rollup row: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def generate_metric_event_data(user_key, event_key, event_value=None, flag_eval_time=None, rng=random):
     """Generate metric event data with proper timestamp handling."""
     # Generate full UUID for event ID
     event_id = str(uuid.uuid4())
     
     # If flag_eval_time is provided, add 5-10 minutes for causality
     if flag_eval_time:
-        offset_minutes = random.uniform(5, 10)
+        offset_minutes = rng.uniform(5, 10)
         received_time = flag_eval_time + timedelta(minutes=offset_minutes)
     else:
         received_time = datetime.now(timezone.utc)
@@ -141,13 +257,15 @@ def generate_metric_event_data(user_key, event_key, event_value=None, flag_eval_
         'received_time': received_time.isoformat()
     }
 
-def generate_user_context():
-    country = random.choice(COUNTRIES)
-    pet_type = random.choice(PET_TYPES)
-    plan_type = random.choice(PLAN_TYPES)
-    payment_type = random.choice(PAYMENT_TYPES)
+def generate_user_context(context_key=None, rng=random, fake=None):
+    from ldclient.context import Context
+    fake = fake or get_faker()
+    country = rng.choice(COUNTRIES)
+    pet_type = rng.choice(PET_TYPES)
+    plan_type = rng.choice(PLAN_TYPES)
+    payment_type = rng.choice(PAYMENT_TYPES)
     state = fake.state_abbr() if country in ["US", "CA"] else fake.city()
-    context_key = str(uuid.uuid4())
+    context_key = context_key or str(uuid.uuid4())
     name = fake.name()
     return Context.builder(context_key) \
         .kind("user") \
@@ -167,42 +285,42 @@ def generate_user_context():
             "name": name
         }
 
-def generate_revenue(plan_type, country):
-    base_prices = {
-        "basic": {"US": 29.99, "CA": 39.99, "UK": 24.99, "EU": 27.99},
-        "premium": {"US": 49.99, "CA": 64.99, "UK": 39.99, "EU": 44.99},
-        "deluxe": {"US": 79.99, "CA": 99.99, "UK": 59.99, "EU": 66.99}
-    }
-    region = "EU" if country in ("FR", "DE") else country
-    base_price = base_prices.get(plan_type, base_prices["basic"]).get(region, base_prices["basic"]["US"])
-    return round(base_price * random.uniform(0.9, 1.1), 2)
-
-def calculate_adjusted_revenue(total_revenue, trial_days, plan_type, country):
-    base_prices = {
-        "basic": {"US": 29.99, "CA": 39.99, "UK": 24.99, "EU": 27.99},
-        "premium": {"US": 49.99, "CA": 64.99, "UK": 39.99, "EU": 44.99},
-        "deluxe": {"US": 79.99, "CA": 99.99, "UK": 59.99, "EU": 66.99}
-    }
+def monthly_price(plan_type, country):
+    """Look up the monthly plan price for a country, falling back to basic/US."""
     region = "EU" if country in ("FR", "DE") else country
-    monthly_price = base_prices.get(plan_type, base_prices["basic"]).get(region, base_prices["basic"]["US"])
-    daily_rate = monthly_price / 30
-    trial_cost = daily_rate * trial_days
-    return max(0, round(total_revenue - trial_cost, 2))
+    return BASE_PRICES.get(plan_type, BASE_PRICES["basic"]).get(region, BASE_PRICES["basic"]["US"])
 
-def simulate_user_journey_v2(ld_client, fake, mode='launchdarkly', snowflake_conn=None):
-    import time
-    import random
-    import json
-    from datetime import datetime
-    user_info = None
-    context, user_info = generate_user_context()
-    
-    # Evaluate the flags with variation_detail
-    trial_days_detail = ld_client.variation_detail('number-of-days-trial', context, 7)
-    seasonal_banner = ld_client.variation('seasonal-sale-banner-text', context, "")
-    hero_banner_detail = ld_client.variation_detail('hero-banner-text', context, {})
-    
-    # Log the full variation_detail objects for debugging
+def generate_revenue(plan_type, country):
+    return round(monthly_price(plan_type, country) * random.uniform(0.9, 1.1), 2)
+
+def hero_banner_variant(hero_banner):
+    """Map a hero-banner-text flag value to its experiment variant name."""
+    if isinstance(hero_banner, dict):
+        hero_banner_text = hero_banner.get("banner-text", "")
+    else:
+        hero_banner_text = str(hero_banner)
+    hero_banner_text = hero_banner_text.lower()
+    if "control" in hero_banner_text:
+        return "Control"
+    elif "next" in hero_banner_text:
+        return "Next Generation"
+    elif "variant" in hero_banner_text or "top" in hero_banner_text:
+        return "Variant 1"
+    return "Control"
+
+def run_hero_banner_funnel(variant, user_info, trial_days, seasonal_banner, model=None, rng=random):
+    """Walk one user through the hero banner funnel; returns [(event_key, value or None)]."""
+    model = model or HERO_BANNER_MODEL
+    return model.run_user(variant, model.region_of(user_info["country"]), {
+        "seasonal_banner": seasonal_banner,
+        "trial_days": trial_days,
+        "monthly_price": model.monthly_price(user_info["planType"], user_info["country"]),
+    }, rng=rng)
+
+_assignment_log_lock = threading.Lock()
+
+def assignment_log_entry(user_info, trial_days_detail, hero_banner_detail, seasonal_banner, snapshot=None):
+    """Build an assignment log entry from the full variation_detail objects (and snapshot, if any)."""
     log_entry = {
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "user_key": user_info["key"],
@@ -220,100 +338,69 @@ def simulate_user_journey_v2(ld_client, fake, mode='launchdarkly', snowflake_con
         },
         "seasonal_banner": seasonal_banner
     }
+    if snapshot is not None:
+        log_entry["flags"] = snapshot.to_log_dict()
+    return log_entry
+
+def write_assignment_log(path, log_entry):
+    """Append one assignment entry to the JSONL assignment log (safe to call from worker threads)."""
+    line = json.dumps(log_entry) + "\n"
+    with _assignment_log_lock:
+        with open(path, "a") as f:
+            f.write(line)
+
+def simulate_user_journey_v2(ld_client, fake, mode='launchdarkly', snowflake_conn=None,
+                             assignment_log_path="experiment_assignments.jsonl", flag_evaluation='per-flag',
+                             context_key=None, flush_each_user=True, rng=None):
+    import time
+    import random
+    import json
+    from datetime import datetime
+    user_info = None
+    # rng and fake let concurrent callers give each worker thread its own generators
+    rng = rng or random
+    context, user_info = generate_user_context(context_key, rng=rng, fake=fake)
+    
+    snapshot = None
+    if flag_evaluation == 'snapshot':
+        # One all_flags_state call instead of three evaluations (no per-flag exposure events)
+        snapshot = evaluate_flag_snapshot(ld_client, context)
+        trial_days_detail = snapshot.detail('number-of-days-trial', 7)
+        seasonal_banner = snapshot.value('seasonal-sale-banner-text', "")
+        hero_banner_detail = snapshot.detail('hero-banner-text', {})
+    else:
+        # Evaluate the flags with variation_detail
+        trial_days_detail = ld_client.variation_detail('number-of-days-trial', context, 7)
+        seasonal_banner = ld_client.variation('seasonal-sale-banner-text', context, "")
+        hero_banner_detail = ld_client.variation_detail('hero-banner-text', context, {})
     
     # Write to JSONL file - let post-analysis determine experiment assignment
-    with open("experiment_assignments.jsonl", "a") as f:
-        f.write(json.dumps(log_entry) + "\n")
+    if assignment_log_path:
+        write_assignment_log(assignment_log_path, assignment_log_entry(
+            user_info, trial_days_detail, hero_banner_detail, seasonal_banner, snapshot
+        ))
     
     # Branch simulation logic based on heroBanner variation
-    hero_banner_text = None
-    if isinstance(hero_banner_detail.value, dict):
-        hero_banner_text = hero_banner_detail.value.get("banner-text", "")
-    else:
-        hero_banner_text = str(hero_banner_detail.value)
-    
-    variant_conversion_rate = {
-        "Control": 0.05,
-        "Variant 1": 0.07,
-        "Next Generation": 0.09
-    }
-    variant_revenue_mean = {
-        "Control": 30.0,
-        "Variant 1": 35.0,
-        "Next Generation": 40.0
-    }
-    variant = "Control"
-    if "control" in hero_banner_text.lower():
-        variant = "Control"
-    elif "next" in hero_banner_text.lower():
-        variant = "Next Generation"
-    elif "variant" in hero_banner_text.lower() or "top" in hero_banner_text.lower():
-        variant = "Variant 1"
+    variant = hero_banner_variant(hero_banner_detail.value)
     
     # Initialize events list
     events = ["page_view"]
     snowflake_events = []
     flag_eval_time = datetime.now(timezone.utc)
     
-    did_signup = random.random() < variant_conversion_rate[variant]
-    if did_signup:
-        events.append("trial_signup")
+    for event_key, event_value in run_hero_banner_funnel(variant, user_info, trial_days_detail.value, seasonal_banner, rng=rng):
+        events.append(event_key)
         if mode == 'launchdarkly':
-            ld_client.track("trial_signup", context)
-        elif mode == 'snowflake':
-            snowflake_events.append(generate_metric_event_data(
-                user_info["key"], "trial_signup", flag_eval_time=flag_eval_time
-            ))
-        
-        # Simulate conversion to paid
-        did_convert = random.random() < 0.5
-        if did_convert:
-            events.append("trial_to_paid_conversion")
-            if mode == 'launchdarkly':
-                ld_client.track("trial_to_paid_conversion", context)
-            elif mode == 'snowflake':
-                snowflake_events.append(generate_metric_event_data(
-                    user_info["key"], "trial_to_paid_conversion", flag_eval_time=flag_eval_time
-                ))
-            
-            revenue = random.gauss(variant_revenue_mean[variant], 5.0)
-            revenue = max(0, round(revenue, 2))
-            events.append("total_revenue")
-            if mode == 'launchdarkly':
-                ld_client.track("total_revenue", context, metric_value=revenue)
-            elif mode == 'snowflake':
-                snowflake_events.append(generate_metric_event_data(
-                    user_info["key"], "total_revenue", event_value=revenue, flag_eval_time=flag_eval_time
-                ))
-            
-            adjusted = calculate_adjusted_revenue(revenue, trial_days_detail.value, user_info["planType"], user_info["country"])
-            events.append("adjusted_revenue")
-            if mode == 'launchdarkly':
-                ld_client.track("adjusted_revenue", context, metric_value=adjusted)
-            elif mode == 'snowflake':
-                snowflake_events.append(generate_metric_event_data(
-                    user_info["key"], "adjusted_revenue", event_value=adjusted, flag_eval_time=flag_eval_time
-                ))
-    
-    if seasonal_banner and random.random() < 0.1:
-        events.append("banner_click")
-        if mode == 'launchdarkly':
-            ld_client.track("banner_click", context)
-        elif mode == 'snowflake':
-            snowflake_events.append(generate_metric_event_data(
-                user_info["key"], "banner_click", flag_eval_time=flag_eval_time
-            ))
-    
-    if random.random() < 0.15:
-        events.append("hero_engagement")
-        if mode == 'launchdarkly':
-            ld_client.track("hero_engagement", context)
+            if event_value is None:
+                ld_client.track(event_key, context)
+            else:
+                ld_client.track(event_key, context, metric_value=event_value)
         elif mode == 'snowflake':
             snowflake_events.append(generate_metric_event_data(
-                user_info["key"], "hero_engagement", flag_eval_time=flag_eval_time
+                user_info["key"], event_key, event_value=event_value, flag_eval_time=flag_eval_time, rng=rng
             ))
     
-    if mode == 'launchdarkly':
+    if mode == 'launchdarkly' and flush_each_user:
         ld_client.flush()
         time.sleep(0.001)
     
@@ -325,70 +412,70 @@ def simulate_user_journey_v2(ld_client, fake, mode='launchdarkly', snowflake_con
     
     return user_info, flag_values, events, snowflake_events
 
-def main():
-    parser = argparse.ArgumentParser(description='Gravity Farms LaunchDarkly Experiment Simulation')
-    parser.add_argument('--flag', default='number-of-days-trial', help='Feature flag key to evaluate')
-    parser.add_argument('--records', type=int, default=100, help='Number of user contexts to simulate')
-    parser.add_argument('--base-signup-prob', type=float, default=0.2, help='Base probability of trial signup')
-    parser.add_argument('--conversion-prob', type=float, default=0.4, help='Probability of trial to paid conversion')
-    parser.add_argument('--mode', choices=['launchdarkly', 'snowflake'], default='launchdarkly', help='Simulation mode (launchdarkly or snowflake)')
-    args = parser.parse_args()
-
+def should_stop_sequential(monitor, users_done, args):
+    """Log sequential test status every --check-every users and decide whether to stop early."""
+    if users_done % args.check_every != 0 and users_done != args.records:
+        return False
+    monitor.log_status()
+    if args.stop_early and monitor.should_stop():
+        logger.info(f"All variant comparisons decided after {users_done} users; stopping early.")
+        return True
+    return False
+
+def run_simulation_mode(args, monitor=None, profiler=None):
+    """Run --records users in LaunchDarkly or Snowflake mode; returns the exit code."""
+    import ldclient
+    from ldclient.config import Config
+
+    events_config = {'events_uri': args.events_uri} if args.events_uri else {}
     sdk_key = os.getenv('LAUNCHDARKLY_SDK_KEY')
     if not sdk_key and args.mode == 'launchdarkly':
         logger.error("LAUNCHDARKLY_SDK_KEY environment variable is not set")
         return 1
 
     if args.mode == 'launchdarkly':
-        ldclient.set_config(Config(sdk_key))
+        ldclient.set_config(Config(sdk_key, **events_config))
         ld_client = ldclient.get()
 
         if not ld_client.is_initialized():
             logger.error("LaunchDarkly client failed to initialize")
             return 1
+        if profiler:
+            profiler.instrument_client(ld_client)
 
         log_filename = f'gravityfarms_simulation_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
         logger.info(f"Results will be logged to {log_filename}")
+        if args.flag_evaluation == 'snapshot':
+            logger.warning(f"Snapshot evaluation sends no exposure events; assignments are recorded in {args.assignment_log} only")
 
         for i in range(args.records):
             context, user_info = generate_user_context()
             # Evaluate the flags
-            trial_days = ld_client.variation(args.flag, context, 7)
-            seasonal_banner = ld_client.variation("seasonal-sale-banner-text", context, "")
-            hero_banner = ld_client.variation("hero-banner-text", context, {})
+            if args.flag_evaluation == 'snapshot':
+                # One all_flags_state call; the assignment log stands in for the missing exposure events
+                snapshot = evaluate_flag_snapshot(ld_client, context)
+                trial_days = snapshot.value(args.flag, 7)
+                seasonal_banner = snapshot.value("seasonal-sale-banner-text", "")
+                hero_banner = snapshot.value("hero-banner-text", {})
+                write_assignment_log(args.assignment_log, assignment_log_entry(
+                    user_info, snapshot.detail(args.flag, 7), snapshot.detail("hero-banner-text", {}),
+                    seasonal_banner, snapshot
+                ))
+            else:
+                trial_days = ld_client.variation(args.flag, context, 7)
+                seasonal_banner = ld_client.variation("seasonal-sale-banner-text", context, "")
+                hero_banner = ld_client.variation("hero-banner-text", context, {})
             logger.info(f"[DEBUG] Context: kind={context.kind}, key={user_info['key']}")
             logger.info(f"[DEBUG] Flag evaluation: {args.flag} = {trial_days} for user: {user_info['key']}")
             logger.info(f"[DEBUG] Flag evaluation: seasonal-sale-banner-text = {seasonal_banner} for user: {user_info['key']}")
             logger.info(f"[DEBUG] Flag evaluation: hero-banner-text = {hero_banner} for user: {user_info['key']}")
             time.sleep(1)  # 1s sleep after flag evaluation
 
-            # Branch simulation logic based on heroBanner variation
-            hero_banner_text = None
-            if isinstance(hero_banner, dict):
-                hero_banner_text = hero_banner.get("banner-text", "")
-            else:
-                hero_banner_text = str(hero_banner)
-
-            variant_conversion_rate = {
-                "Control": 0.05,
-                "Variant 1": 0.07,
-                "Next Generation": 0.09
-            }
-            variant_revenue_mean = {
-                "Control": 30.0,
-                "Variant 1": 35.0,
-                "Next Generation": 40.0
-            }
-            variant = "Control"
-            if "control" in hero_banner_text.lower():
-                variant = "Control"
-            elif "next" in hero_banner_text.lower():
-                variant = "Next Generation"
-            elif "variant" in hero_banner_text.lower() or "top" in hero_banner_text.lower():
-                variant = "Variant 1"
-
-            # Simulate trial signup based on hero banner variant
-            did_signup = random.random() < variant_conversion_rate[variant]
+            variant = hero_banner_variant(hero_banner)
+            outcomes = run_hero_banner_funnel(variant, user_info, trial_days, seasonal_banner)
+            fired = {event_key for event_key, _ in outcomes}
+            did_signup = "trial_signup" in fired
+            user_revenue = 0.0
             log_entry = {
                 "timestamp": int(time.time() * 1000),
                 "context_key": user_info['key'],
@@ -396,34 +483,18 @@ def main():
                 "trial_signup": did_signup,
                 "events": []
             }
-
             if did_signup:
-                ld_client.track("trial_signup", context)
-                logger.info(f"[DEBUG] Tracking event: trial_signup for user: {user_info['key']}")
-                # Simulate conversion to paid
-                did_convert = random.random() < 0.5
-                log_entry["trial_to_paid_conversion"] = did_convert
-                if did_convert:
-                    ld_client.track("trial_to_paid_conversion", context)
-                    logger.info(f"[DEBUG] Tracking event: trial_to_paid_conversion for user: {user_info['key']}")
-                    # Revenue events
-                    revenue = random.gauss(variant_revenue_mean[variant], 5.0)
-                    revenue = max(0, round(revenue, 2))
-                    ld_client.track("total_revenue", context, metric_value=revenue)
-                    logger.info(f"[DEBUG] Tracking event: total_revenue for user: {user_info['key']} value: {revenue}")
-                    adjusted = calculate_adjusted_revenue(revenue, trial_days, user_info["planType"], user_info["country"])
-                    ld_client.track("adjusted_revenue", context, metric_value=adjusted)
-                    logger.info(f"[DEBUG] Tracking event: adjusted_revenue for user: {user_info['key']} value: {adjusted}")
-
-            # Track banner_click event if seasonal banner is present and random threshold met
-            if seasonal_banner and random.random() < 0.1:
-                ld_client.track("banner_click", context)
-                logger.info(f"[DEBUG] Tracking event: banner_click for user: {user_info['key']}")
-
-            # Track hero_engagement event with random chance
-            if random.random() < 0.15:
-                ld_client.track("hero_engagement", context)
-                logger.info(f"[DEBUG] Tracking event: hero_engagement for user: {user_info['key']}")
+                log_entry["trial_to_paid_conversion"] = "trial_to_paid_conversion" in fired
+
+            for event_key, event_value in outcomes:
+                if event_value is None:
+                    ld_client.track(event_key, context)
+                    logger.info(f"[DEBUG] Tracking event: {event_key} for user: {user_info['key']}")
+                else:
+                    ld_client.track(event_key, context, metric_value=event_value)
+                    logger.info(f"[DEBUG] Tracking event: {event_key} for user: {user_info['key']} value: {event_value}")
+                    if event_key == "total_revenue":
+                        user_revenue = event_value
 
             # Flush after each user
             ld_client.flush()
@@ -437,45 +508,101 @@ def main():
             if (i + 1) % 10 == 0 or (i + 1) == args.records:
                 logger.info(f"Processed {i + 1}/{args.records} users")
 
+            if monitor:
+                monitor.observe(variant, did_signup, user_revenue)
+                if should_stop_sequential(monitor, i + 1, args):
+                    break
+
             time.sleep(0.01)
 
         ld_client.close()
         logger.info("Simulation complete.")
 
     elif args.mode == 'snowflake':
-        if not SNOWFLAKE_AVAILABLE:
+        if not is_snowflake_available():
             logger.error("Snowflake mode selected but snowflake-connector-python is not installed.")
             return 1
 
         # Still need LaunchDarkly SDK for flag evaluation
-        ldclient.set_config(Config(sdk_key))
+        ldclient.set_config(Config(sdk_key, **events_config))
         ld_client = ldclient.get()
 
         if not ld_client.is_initialized():
             logger.error("LaunchDarkly client failed to initialize")
             return 1
+        if profiler:
+            profiler.instrument_client(ld_client)
 
         conn = None
+        spool = None
+        rollup_spool = None
+        rollup = None
         try:
             conn = get_snowflake_connection()
             logger.info("Snowflake connection successful.")
 
+            # Events are written to the local spool first and delivered by a background worker
+            spool = MetricEventSpool(
+                args.spool_dir, lambda event_data: insert_metric_event_to_snowflake(conn, event_data),
+                max_attempts=args.spool_max_attempts, permanent_error=is_permanent_snowflake_error
+            )
+            if args.requeue_dead_letters:
+                spool.requeue_dead_letters()
+            if args.sink == 'rollup':
+                rollup_spool = MetricEventSpool(
+                    os.path.join(args.spool_dir, 'rollups'),
+                    lambda rollup_row: insert_metric_rollup_to_snowflake(conn, rollup_row),
+                    id_field='rollup_id', max_attempts=args.spool_max_attempts,
+                    permanent_error=is_permanent_snowflake_error
+                )
+                if args.requeue_dead_letters:
+                    rollup_spool.requeue_dead_letters()
+                rollup = MetricRollupSink(
+                    rollup_spool.append,
+                    bucket_seconds=args.rollup_bucket_seconds,
+                    grace_seconds=args.rollup_grace_seconds,
+                    raw_sample_rate=args.raw_sample_rate,
+                    raw_sink=spool.append
+                )
+                logger.info(f"Rollup sink enabled ({args.rollup_bucket_seconds}s buckets, raw sample rate {args.raw_sample_rate})")
+            if profiler:
+                # After the rollup captured spool.append as its raw sink, so sampled raw writes are not counted twice
+                profiler.instrument_object(spool, {'append': 'sink_write'})
+                if rollup:
+                    profiler.instrument_object(rollup, {'add': 'sink_write'})
+
             for i in range(args.records):
                 # Use the updated simulate_user_journey_v2 function
                 user_info, flag_values, events, snowflake_events = simulate_user_journey_v2(
-                    ld_client, fake, mode='snowflake', snowflake_conn=conn
+                    ld_client, get_faker(), mode='snowflake', snowflake_conn=conn,
+                    assignment_log_path=args.assignment_log, flag_evaluation=args.flag_evaluation
                 )
 
-                # Insert metric events into Snowflake
-                for event_data in snowflake_events:
-                    try:
-                        insert_metric_event_to_snowflake(conn, event_data)
-                    except Exception as e:
-                        logger.error(f"Error inserting metric event to Snowflake: {e}")
+                if rollup:
+                    # Aggregate by hero banner variant; raw events are only sampled
+                    variant = hero_banner_variant(flag_values['heroBanner'])
+                    for event_data in snowflake_events:
+                        rollup.add(event_data, 'hero-banner-text', variant)
+                else:
+                    # Spool metric events for asynchronous insertion into Snowflake
+                    for event_data in snowflake_events:
+                        spool.append(event_data)
 
                 # Log progress
                 if (i + 1) % 10 == 0 or (i + 1) == args.records:
-                    logger.info(f"Processed {i + 1}/{args.records} users")
+                    spool_stats = spool.stats()
+                    logger.info(
+                        f"Processed {i + 1}/{args.records} users "
+                        f"(spool depth: {spool_stats['depth']}, replay rate: {spool_stats['replay_rate']:.1f}/s)"
+                    )
+
+                if monitor:
+                    user_revenue = sum(
+                        e['event_value'] for e in snowflake_events if e['event_key'] == 'total_revenue'
+                    )
+                    monitor.observe(hero_banner_variant(flag_values['heroBanner']), 'trial_signup' in events, user_revenue)
+                    if should_stop_sequential(monitor, i + 1, args):
+                        break
 
                 time.sleep(0.01)  # Small delay between users
 
@@ -484,12 +611,107 @@ def main():
         except Exception as e:
             logger.error(f"Error during Snowflake simulation: {e}")
         finally:
+            if rollup:
+                rollup.flush()
+                logger.info(f"Rollup sink closed: {rollup.stats}")
+            if rollup_spool:
+                rollup_spool.close(drain_timeout=args.spool_drain_timeout)
+            if spool:
+                spool.close(drain_timeout=args.spool_drain_timeout)
+                logger.info(f"Metric event spool closed: {spool.stats()}")
             if conn:
                 conn.close()
                 logger.info("Snowflake connection closed.")
             ld_client.close()
-
     return 0
 
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    configure_logging()
+
+    parser = argparse.ArgumentParser(description='Gravity Farms LaunchDarkly Experiment Simulation')
+    parser.add_argument('--flag', default='number-of-days-trial', help='Feature flag key to evaluate')
+    parser.add_argument('--records', type=int, default=100, help='Number of user contexts to simulate')
+    parser.add_argument('--base-signup-prob', type=float, default=0.2, help='Base probability of trial signup')
+    parser.add_argument('--conversion-prob', type=float, default=0.4, help='Probability of trial to paid conversion')
+    parser.add_argument('--mode', choices=['launchdarkly', 'snowflake'], default='launchdarkly', help='Simulation mode (launchdarkly or snowflake)')
+    parser.add_argument('--spool-dir', default='metric_spool', help='Directory for the durable Snowflake metric event spool')
+    parser.add_argument('--spool-drain-timeout', type=float, default=30.0, help='Seconds to wait for the spool to drain before exiting')
+    parser.add_argument('--spool-max-attempts', type=int, default=3, help='Attempts before a metric event failing with a non-retryable error (bad SQL or data) is moved to the spool dead-letter file; outages are retried indefinitely')
+    parser.add_argument('--requeue-dead-letters', action='store_true', help='Move dead-lettered metric events back into the spool at startup')
+    parser.add_argument('--events-uri', help='LaunchDarkly events base URI (e.g. a local mock_events_server.py)')
+    parser.add_argument('--flag-evaluation', choices=['per-flag', 'snapshot'], default='per-flag', help='Evaluate flags one call per flag or as one all_flags_state snapshot per user (snapshots send no exposure events; assignments go to --assignment-log)')
+    parser.add_argument('--assignment-log', default='experiment_assignments.jsonl', help='JSONL file recording each user\'s flag assignments')
+    parser.add_argument('--sink', choices=['events', 'rollup'], default='events', help='Snowflake output: raw metric events or per-bucket rollups')
+    parser.add_argument('--rollup-bucket-seconds', type=int, default=60, help='Rollup time bucket size in seconds')
+    parser.add_argument('--rollup-grace-seconds', type=int, default=600, help='Late-arrival grace window before a rollup bucket closes (covers the 5-10 minute event offset)')
+    parser.add_argument('--raw-sample-rate', type=float, default=0.0, help='Fraction of raw events also written in rollup mode')
+    parser.add_argument('--dry-run', type=int, metavar='N', help='Vectorized Monte Carlo dry run of N users (no LaunchDarkly calls)')
+    parser.add_argument('--dry-run-validate', type=int, default=0, metavar='M', help='Also run M users through the per-user path offline and compare')
+    parser.add_argument('--variant-weights', default='Control=1,Variant 1=1,Next Generation=1', help='Dry-run hero banner rollout weights')
+    parser.add_argument('--trial-days-weights', default='7=1', help='Dry-run number-of-days-trial rollout weights')
+    parser.add_argument('--seasonal-banner-share', type=float, default=1.0, help='Dry-run share of users shown the seasonal banner')
+    parser.add_argument('--seed', type=int, help='Random seed for the dry run')
+    parser.add_argument('--sequential', action='store_true', help='Track always-valid variant comparisons while the run progresses')
+    parser.add_argument('--stop-early', action='store_true', help='Stop once every variant comparison is significant or futile (implies --sequential)')
+    parser.add_argument('--alpha', type=float, default=0.05, help='Sequential test significance level')
+    parser.add_argument('--conversion-mde', type=float, default=0.01, help='Minimum detectable trial signup rate difference')
+    parser.add_argument('--revenue-mde', type=float, default=0.5, help='Minimum detectable revenue-per-user difference')
+    parser.add_argument('--check-every', type=int, default=100, help='Users between sequential test checks')
+    parser.add_argument('--coordinator', metavar='HOST:PORT', help='Coordinate distributed workers for --records users instead of simulating locally')
+    parser.add_argument('--worker', metavar='HOST:PORT', help='Run as a distributed worker pulling user ranges from a coordinator')
+    parser.add_argument('--cluster-rate', type=float, help='Cluster-wide users/second budget for --coordinator')
+    parser.add_argument('--range-size', type=int, default=500, help='Users per work range handed out by --coordinator')
+    parser.add_argument('--offline', action='store_true', help='Distributed workers use an offline flag client instead of LaunchDarkly')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        if args.coordinator:
+            from distributed import Coordinator
+            Coordinator(args.coordinator, args.records, range_size=args.range_size, rate=args.cluster_rate).serve()
+            return 0
+        if args.worker:
+            from distributed import run_worker
+            return run_worker(args.worker, offline=args.offline, mode=args.mode, flag_evaluation=args.flag_evaluation,
+                              spool_dir=args.spool_dir, spool_drain_timeout=args.spool_drain_timeout,
+                              spool_max_attempts=args.spool_max_attempts)
+    except ValueError as e:
+        # Unsafe cluster settings (e.g. the default authkey on a public address)
+        logger.error(str(e))
+        return 1
+
+    if args.dry_run:
+        from monte_carlo import run_dry_run, parse_weights
+        return run_dry_run(
+            args.dry_run,
+            parse_weights(args.variant_weights),
+            parse_weights(args.trial_days_weights, cast=int),
+            seasonal_banner_share=args.seasonal_banner_share,
+            seed=args.seed,
+            validate_users=args.dry_run_validate
+        )
+
+    monitor = None
+    if args.sequential or args.stop_early:
+        monitor = SequentialMonitor(
+            VARIANT_CONVERSION_RATE, alpha=args.alpha,
+            mde={'conversion': args.conversion_mde, 'revenue': args.revenue_mde}
+        )
+
+    profiler = None
+    if args.profile:
+        profiler = SimulationProfiler(args.profile, args.profile_output, args.profile_interval_ms)
+        profiler.instrument_module(sys.modules[__name__], PROFILE_STAGES)
+        profiler.start()
+
+    try:
+        return run_simulation_mode(args, monitor, profiler)
+    finally:
+        # Also on the early error returns, so the sampler stops and the report is written
+        if profiler:
+            profiler.stop()
+
 if __name__ == "__main__":
     exit(main()) 
\ No newline at end of file
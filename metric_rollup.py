@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Pre-aggregated rollup sink for metric events.
+
+Aggregates metric events in memory by (time bucket, flag, variation, event_key)
+and emits one count / sum / sum-of-squares row per group when its bucket
+closes. A bucket closes once the event-time watermark passes its end plus a
+grace window, so late events can still land in the right bucket. Events that
+arrive after their bucket closed start a new partial row for the same bucket;
+because the aggregates are additive, summing rows per key stays correct.
+"""
+
+import uuid
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger('gravityfarms-rollup')
+
+
+def _event_timestamp(event_data):
+    received_time = event_data['received_time']
+    if isinstance(received_time, datetime):
+        return received_time.timestamp()
+    return datetime.fromisoformat(received_time).timestamp()
+
+
+def _sampled(event_id, rate):
+    """Deterministically sample an event by its UUID so replays pick the same events."""
+    if rate >= 1.0:
+        return True
+    if rate <= 0.0:
+        return False
+    return int(uuid.UUID(event_id).hex[:8], 16) / 0x100000000 < rate
+
+
+class MetricRollupSink:
+    """Rolls metric events up into per-bucket aggregate rows."""
+
+    def __init__(self, emit, bucket_seconds=60, grace_seconds=600,
+                 raw_sample_rate=0.0, raw_sink=None):
+        self.emit = emit
+        self.bucket_seconds = bucket_seconds
+        self.grace_seconds = grace_seconds
+        self.raw_sample_rate = raw_sample_rate
+        self.raw_sink = raw_sink
+
+        # (bucket_start, flag_key, variation, event_key) -> [count, value_count, sum, sum_sq]
+        self._buckets = {}
+        self._watermark = None
+        self.stats = {
+            'events_in': 0,
+            'rows_out': 0,
+            'raw_sampled': 0,
+            'late_events': 0,
+        }
+        self._closed_through = None
+        self._last_cutoff_bucket = None
+
+    def add(self, event_data, flag_key, variation):
+        """Aggregate one metric event attributed to a flag variation."""
+        ts = _event_timestamp(event_data)
+        bucket_start = int(ts // self.bucket_seconds) * self.bucket_seconds
+        if self._closed_through is not None and bucket_start < self._closed_through:
+            self.stats['late_events'] += 1
+
+        key = (bucket_start, flag_key, str(variation), event_data['event_key'])
+        agg = self._buckets.get(key)
+        if agg is None:
+            agg = self._buckets[key] = [0, 0, 0.0, 0.0]
+        agg[0] += 1
+        value = event_data.get('event_value')
+        if value is not None:
+            agg[1] += 1
+            agg[2] += value
+            agg[3] += value * value
+        self.stats['events_in'] += 1
+
+        if self.raw_sink is not None and _sampled(event_data['event_id'], self.raw_sample_rate):
+            self.raw_sink(event_data)
+            self.stats['raw_sampled'] += 1
+
+        if self._watermark is None or ts > self._watermark:
+            self._watermark = ts
+            self._close_ready()
+
+    def _close_ready(self):
+        """Emit every bucket whose end plus the grace window is behind the watermark."""
+        cutoff = self._watermark - self.grace_seconds - self.bucket_seconds
+        # Only rescan when the cutoff crosses into a new bucket
+        cutoff_bucket = int(cutoff // self.bucket_seconds)
+        if cutoff_bucket == self._last_cutoff_bucket:
+            return
+        self._last_cutoff_bucket = cutoff_bucket
+        ready = [key for key in self._buckets if key[0] <= cutoff]
+        if ready:
+            self._emit(ready)
+            closed_through = max(key[0] for key in ready) + self.bucket_seconds
+            if self._closed_through is None or closed_through > self._closed_through:
+                self._closed_through = closed_through
+
+    def _emit(self, keys):
+        rows = []
+        for key in sorted(keys):
+            bucket_start, flag_key, variation, event_key = key
+            count, value_count, value_sum, value_sum_sq = self._buckets.pop(key)
+            rows.append({
+                'rollup_id': str(uuid.uuid4()),
+                'bucket_start': datetime.fromtimestamp(bucket_start, tz=timezone.utc).isoformat(),
+                'bucket_seconds': self.bucket_seconds,
+                'flag_key': flag_key,
+                'variation': variation,
+                'event_key': event_key,
+                'event_count': count,
+                'value_count': value_count,
+                'value_sum': round(value_sum, 6),
+                'value_sum_sq': round(value_sum_sq, 6),
+            })
+        for row in rows:
+            self.emit(row)
+        self.stats['rows_out'] += len(rows)
+        logger.debug(f"Emitted {len(rows)} rollup rows")
+
+    def flush(self):
+        """Close all open buckets regardless of the watermark."""
+        if self._buckets:
+            self._emit(list(self._buckets))
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Durable local spool for Snowflake metric events.
+
+Metric events are appended to segment files on local disk before any
+warehouse write is attempted. A background worker drains the spool into a
+sink callable with exponential backoff, skipping events whose ID (event_id
+by default) has already been delivered. Undelivered events survive a process restart.
+Transient failures (outages, timeouts) are retried indefinitely with capped backoff.
+Only records that can never be delivered are moved to dead_letter.jsonl, so they do
+not block the events behind them: lines that cannot be parsed, and events whose
+failure the permanent_error predicate classifies as non-retryable (after
+max_attempts tries). requeue_dead_letters() moves them back once the cause is fixed.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('gravityfarms-spool')
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.jsonl'
+CHECKPOINT_FILE = 'checkpoint.json'
+DELIVERED_FILE = 'delivered.ids'
+DEAD_LETTER_FILE = 'dead_letter.jsonl'
+
+
+def _segment_name(seq):
+    return f"{SEGMENT_PREFIX}{seq:08d}{SEGMENT_SUFFIX}"
+
+
+def _list_segments(spool_dir):
+    """Return the sorted sequence numbers of segment files in spool_dir."""
+    seqs = []
+    for name in os.listdir(spool_dir):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            try:
+                seqs.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+            except ValueError:
+                continue
+    return sorted(seqs)
+
+
+class MetricEventSpool:
+    """Append-only, fsync-batched write-ahead spool with an async retry worker."""
+
+    def __init__(self, spool_dir, sink, fsync_every=100, fsync_interval=1.0,
+                 max_segment_bytes=16 * 1024 * 1024, backoff_base=0.5,
+                 backoff_max=60.0, dedupe_window=100000, checkpoint_every=100,
+                 id_field='event_id', max_attempts=3, permanent_error=None):
+        self.spool_dir = spool_dir
+        self.sink = sink
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dedupe_window = dedupe_window
+        self.checkpoint_every = checkpoint_every
+        self.id_field = id_field
+        # Attempts before an event failing with a permanent error is dead-lettered
+        self.max_attempts = max_attempts
+        # permanent_error(exc) -> True when retrying cannot help; None treats every failure as transient
+        self.permanent_error = permanent_error
+
+        os.makedirs(spool_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._stopping = False
+        self._closed = False
+        # Set by the drain worker on exit; close() only releases files the worker is done with
+        self._worker_exited = False
+        self._abandoned = False
+
+        # Recently delivered event IDs, bounded to dedupe_window entries
+        self._delivered = OrderedDict()
+        self._replay_times = deque()
+        self.stats_counters = {
+            'spooled': 0,
+            'replayed': 0,
+            'duplicates_skipped': 0,
+            'retries': 0,
+            'fsyncs': 0,
+            'dead_lettered': 0,
+        }
+
+        self._read_seq, self._read_offset = self._load_checkpoint()
+        self._load_delivered_ids()
+        self._depth = self._count_pending()
+        if self._depth:
+            logger.info(f"Recovered {self._depth} undelivered metric events from {spool_dir}")
+
+        segments = _list_segments(spool_dir)
+        self._write_seq = max(segments[-1] if segments else 0, self._read_seq)
+        if self._has_torn_tail(self._write_seq):
+            # A crash mid-write left a partial record; never append after it
+            self._write_seq += 1
+        self._reader = None
+        self._writer = open(os.path.join(spool_dir, _segment_name(self._write_seq)), 'ab')
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._delivered_log = open(os.path.join(spool_dir, DELIVERED_FILE), 'a')
+        self._dead_letter = None
+        self._since_checkpoint = 0
+
+        self._worker = threading.Thread(target=self._drain_loop, name='metric-spool-drain', daemon=True)
+        self._worker.start()
+
+    # ---- persistence ----
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.spool_dir, CHECKPOINT_FILE)
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                return int(data['segment']), int(data['offset'])
+            except (ValueError, KeyError, OSError) as e:
+                logger.warning(f"Ignoring unreadable spool checkpoint {path}: {e}")
+        segments = _list_segments(self.spool_dir)
+        return (segments[0] if segments else 0), 0
+
+    def _write_checkpoint(self):
+        """Persist the read position atomically and reset the delivered-ID log."""
+        path = os.path.join(self.spool_dir, CHECKPOINT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'segment': self._read_seq, 'offset': self._read_offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # IDs delivered before the checkpoint can no longer be replayed
+        self._delivered_log.seek(0)
+        self._delivered_log.truncate()
+        self._delivered_log.flush()
+        self._since_checkpoint = 0
+
+    def _load_delivered_ids(self):
+        path = os.path.join(self.spool_dir, DELIVERED_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                event_id = line.strip()
+                if event_id:
+                    self._remember_delivered(event_id)
+
+    def _remember_delivered(self, event_id):
+        self._delivered[event_id] = None
+        if len(self._delivered) > self.dedupe_window:
+            self._delivered.popitem(last=False)
+
+    def _count_pending(self):
+        pending = 0
+        for seq in _list_segments(self.spool_dir):
+            if seq < self._read_seq:
+                continue
+            with open(os.path.join(self.spool_dir, _segment_name(seq)), 'rb') as f:
+                if seq == self._read_seq:
+                    f.seek(self._read_offset)
+                pending += sum(1 for line in f if line.endswith(b'\n'))
+        return pending
+
+    def _has_torn_tail(self, seq):
+        path = os.path.join(self.spool_dir, _segment_name(seq))
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return False
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    def _write_dead_letter(self, record, reason, attempts):
+        """Append an undeliverable record to the dead-letter file. Caller holds the lock."""
+        if self._dead_letter is None:
+            self._dead_letter = open(os.path.join(self.spool_dir, DEAD_LETTER_FILE), 'a')
+        self._dead_letter.write(json.dumps({
+            'segment': self._read_seq,
+            'offset': self._read_offset,
+            'attempts': attempts,
+            'error': reason,
+            'dead_lettered_at': time.time(),
+            'record': record,
+        }) + '\n')
+        self._dead_letter.flush()
+        os.fsync(self._dead_letter.fileno())
+        self.stats_counters['dead_lettered'] += 1
+        logger.error(f"Moved undeliverable spool record to {DEAD_LETTER_FILE} ({attempts} delivery attempts): {reason}")
+
+    def _advance(self, next_offset):
+        """Commit the read position past the current record. Caller holds the lock."""
+        self._read_offset = next_offset
+        self._depth -= 1
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self._write_checkpoint()
+        self._cond.notify_all()
+
+    def _maybe_fsync(self, force=False):
+        """Flush and fsync the active segment once a batch has accumulated. Caller holds the lock."""
+        if not self._unsynced:
+            return
+        if force or self._unsynced >= self.fsync_every or \
+                time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+            self.stats_counters['fsyncs'] += 1
+
+    # ---- producer side ----
+
+    def append(self, event_data):
+        """Write a metric event to the spool; delivery happens asynchronously."""
+        line = (json.dumps(event_data, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Metric event spool is closed")
+            if self._writer.tell() + len(line) > self.max_segment_bytes and self._writer.tell() > 0:
+                self._maybe_fsync(force=True)
+                self._writer.close()
+                self._write_seq += 1
+                self._writer = open(os.path.join(self.spool_dir, _segment_name(self._write_seq)), 'ab')
+            self._writer.write(line)
+            # Make the record visible to the drain worker; durability comes from the batched fsync
+            self._writer.flush()
+            self._unsynced += 1
+            self._maybe_fsync()
+            self._depth += 1
+            self.stats_counters['spooled'] += 1
+            self._cond.notify()
+
+    # ---- consumer side ----
+
+    def _next_record(self):
+        """Return (event, next_offset) for the record at the read position, or None. Caller holds the lock."""
+        while True:
+            path = os.path.join(self.spool_dir, _segment_name(self._read_seq))
+            if self._reader is None and os.path.exists(path):
+                self._reader = open(path, 'rb')
+            if self._reader is not None:
+                # Always read from the committed position so a failed delivery is retried
+                self._reader.seek(self._read_offset)
+                line = self._reader.readline()
+                if line.endswith(b'\n'):
+                    try:
+                        return json.loads(line), self._read_offset + len(line)
+                    except ValueError as e:
+                        # A corrupt record can never be delivered; set it aside and move on
+                        self._write_dead_letter(line.decode('utf-8', 'replace'), f"unparseable record: {e}", 0)
+                        self._advance(self._read_offset + len(line))
+                        self._write_checkpoint()
+                        continue
+            # End of a sealed segment: advance to the next one and reclaim disk
+            if self._read_seq < self._write_seq:
+                if self._reader is not None:
+                    self._reader.close()
+                    self._reader = None
+                if os.path.exists(path):
+                    os.remove(path)
+                self._read_seq += 1
+                self._read_offset = 0
+                self._write_checkpoint()
+                continue
+            return None
+
+    def _drain_loop(self):
+        try:
+            self._drain()
+        finally:
+            with self._cond:
+                self._worker_exited = True
+                if self._abandoned:
+                    # close() timed out while a delivery was in flight and left the files to us
+                    self._release_files()
+
+    def _drain(self):
+        attempt = 0
+        while True:
+            with self._cond:
+                record = self._next_record()
+                while record is None and not self._stopping:
+                    self._cond.wait(timeout=self.fsync_interval)
+                    self._maybe_fsync()
+                    record = self._next_record()
+                # Once close() gives up waiting, stop delivering instead of draining the backlog
+                if record is None or self._stopping:
+                    return
+            event, next_offset = record
+            event_id = event.get(self.id_field)
+
+            if event_id is not None and event_id in self._delivered:
+                self.stats_counters['duplicates_skipped'] += 1
+            else:
+                try:
+                    self.sink(event)
+                except Exception as e:
+                    attempt += 1
+                    permanent = self.permanent_error is not None and self.permanent_error(e)
+                    if permanent and attempt >= self.max_attempts:
+                        with self._cond:
+                            self._write_dead_letter(event, str(e), attempt)
+                            self._advance(next_offset)
+                            # Persist right away so a restart does not dead-letter the record twice
+                            self._write_checkpoint()
+                        attempt = 0
+                        continue
+                    self.stats_counters['retries'] += 1
+                    delay = min(self.backoff_max, self.backoff_base * (2 ** min(attempt - 1, 30)))
+                    delay *= random.uniform(0.5, 1.0)
+                    kind = "permanent error" if permanent else "transient error"
+                    logger.warning(f"Spool delivery failed (attempt {attempt}, {kind}), retrying in {delay:.1f}s: {e}")
+                    with self._cond:
+                        if self._stopping:
+                            return
+                        self._cond.wait(timeout=delay)
+                    continue
+                attempt = 0
+                if event_id is not None:
+                    self._remember_delivered(event_id)
+                    self._delivered_log.write(event_id + '\n')
+                    self._delivered_log.flush()
+                self.stats_counters['replayed'] += 1
+                self._replay_times.append(time.monotonic())
+
+            with self._cond:
+                self._advance(next_offset)
+
+    # ---- lifecycle and metrics ----
+
+    def _release_files(self):
+        """Persist the read position and close every file. Caller holds the lock."""
+        self._writer.close()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._write_checkpoint()
+        self._delivered_log.close()
+        if self._dead_letter is not None:
+            self._dead_letter.close()
+
+    def requeue_dead_letters(self):
+        """Append dead-lettered events back to the spool; unparseable records stay. Returns the count."""
+        path = os.path.join(self.spool_dir, DEAD_LETTER_FILE)
+        with self._cond:
+            if self._dead_letter is not None:
+                self._dead_letter.close()
+                self._dead_letter = None
+            if not os.path.exists(path):
+                return 0
+            with open(path) as f:
+                lines = f.readlines()
+        kept = []
+        requeued = 0
+        for line in lines:
+            entry = json.loads(line)
+            if isinstance(entry.get('record'), dict):
+                self.append(entry['record'])
+                requeued += 1
+            else:
+                kept.append(line)
+        with self._cond:
+            # Requeued events are durable before they leave the dead-letter file; a crash in
+            # between only duplicates them, and delivery dedupes by ID
+            self._maybe_fsync(force=True)
+            if self._dead_letter is not None:
+                self._dead_letter.close()
+                self._dead_letter = None
+            # Keep anything the worker dead-lettered while we were requeueing
+            with open(path) as f:
+                kept.extend(f.readlines()[len(lines):])
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.writelines(kept)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        if requeued:
+            logger.info(f"Requeued {requeued} dead-lettered events from {path}")
+        return requeued
+
+    def stats(self, window_seconds=60.0):
+        """Return spool depth, counters and the replay rate over the last window_seconds."""
+        now = time.monotonic()
+        while self._replay_times and now - self._replay_times[0] > window_seconds:
+            self._replay_times.popleft()
+        elapsed = min(window_seconds, now - self._replay_times[0]) if self._replay_times else 0
+        return {
+            'depth': self._depth,
+            'replay_rate': len(self._replay_times) / elapsed if elapsed > 0 else 0.0,
+            **self.stats_counters,
+        }
+
+    def wait_until_drained(self, timeout=None):
+        """Block until every spooled event has been delivered. Returns True if drained."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._depth > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining if remaining is not None else 1.0)
+        return True
+
+    def close(self, drain_timeout=30.0):
+        """Stop accepting events, try to drain, then fsync and persist the read position."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._maybe_fsync(force=True)
+        deadline = time.monotonic() + drain_timeout
+        drained = self.wait_until_drained(timeout=drain_timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        # An idle or backing-off worker exits at once; a sink call in flight is not waited for beyond the timeout
+        self._worker.join(timeout=max(0.5, deadline - time.monotonic()))
+        with self._cond:
+            if self._worker_exited:
+                self._release_files()
+            else:
+                # The worker is still inside a sink call and will write to the delivered log
+                # when it returns; it persists the checkpoint and closes the files itself
+                self._abandoned = True
+                logger.warning("Spool drain worker still busy after close(); it will persist the checkpoint on exit")
+        if not drained:
+            logger.warning(f"{self._depth} metric events left in spool {self.spool_dir}; they will be replayed on next start")
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Local LaunchDarkly events endpoint stand-in.
+
+Implements the server-side SDK event endpoints (POST /bulk and
+/diagnostic) and records payload counts, wire and decoded sizes,
+compression, events per payload and ingest latency. Slow responses and
+5xx errors can be injected to exercise the SDK's retry and flush behavior.
+Point an SDK at it with Config(sdk_key, events_uri='http://127.0.0.1:8787'),
+or run the bundled benchmark to compare flush policies end to end offline:
+
+    python mock_events_server.py --port 8787                  # serve until Ctrl+C
+    python mock_events_server.py --benchmark --users 5000     # offline flush-policy benchmark
+"""
+
+import gzip
+import json
+import time
+import random
+import argparse
+import threading
+import statistics
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from gravityfarms_simulation import configure_logging, logger
+
+
+class EventsRecorder:
+    """Thread-safe accumulator of what the mock endpoint received."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.payloads = 0
+            self.diagnostic_payloads = 0
+            self.events = 0
+            self.wire_bytes = 0
+            self.decoded_bytes = 0
+            self.compressed_payloads = 0
+            self.injected_errors = 0
+            self.events_per_payload = []
+            self.handle_seconds = []
+            self.event_age_ms = []
+            self.event_kinds = Counter()
+            self.started_at = time.monotonic()
+
+    def record(self, path, wire_size, body, compressed, handle_seconds):
+        now_ms = time.time() * 1000
+        with self._lock:
+            if path.endswith('/diagnostic'):
+                self.diagnostic_payloads += 1
+                return
+            self.payloads += 1
+            self.wire_bytes += wire_size
+            self.decoded_bytes += len(body)
+            self.compressed_payloads += compressed
+            self.handle_seconds.append(handle_seconds)
+            try:
+                events = json.loads(body)
+            except ValueError:
+                events = []
+            self.events += len(events)
+            self.events_per_payload.append(len(events))
+            for event in events:
+                self.event_kinds[event.get('kind')] += 1
+                # Delivery latency: time from event creation in the SDK to arrival here
+                if 'creationDate' in event:
+                    self.event_age_ms.append(now_ms - event['creationDate'])
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started_at
+
+            def percentile(values, q):
+                if not values:
+                    return None
+                ordered = sorted(values)
+                return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+            return {
+                'payloads': self.payloads,
+                'diagnostic_payloads': self.diagnostic_payloads,
+                'events': self.events,
+                'event_kinds': dict(self.event_kinds),
+                'wire_bytes': self.wire_bytes,
+                'decoded_bytes': self.decoded_bytes,
+                'compression_ratio': self.decoded_bytes / self.wire_bytes if self.wire_bytes else None,
+                'compressed_payloads': self.compressed_payloads,
+                'injected_errors': self.injected_errors,
+                'events_per_payload_mean': statistics.mean(self.events_per_payload) if self.events_per_payload else None,
+                'events_per_payload_max': max(self.events_per_payload, default=None),
+                'handle_ms_p50': (percentile(self.handle_seconds, 0.5) or 0) * 1000,
+                'handle_ms_p99': (percentile(self.handle_seconds, 0.99) or 0) * 1000,
+                'event_age_ms_p50': percentile(self.event_age_ms, 0.5),
+                'event_age_ms_p99': percentile(self.event_age_ms, 0.99),
+                'payloads_per_second': self.payloads / elapsed if elapsed else 0.0,
+                'events_per_second': self.events / elapsed if elapsed else 0.0,
+            }
+
+
+def make_handler(recorder, delay_ms=0, error_rate=0.0, error_status=503):
+    class EventsHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            start = time.perf_counter()
+            length = int(self.headers.get('Content-Length', 0))
+            raw = self.rfile.read(length)
+            compressed = self.headers.get('Content-Encoding', '').lower() == 'gzip'
+            body = gzip.decompress(raw) if compressed else raw
+
+            if delay_ms:
+                time.sleep(delay_ms / 1000)
+            if error_rate and random.random() < error_rate:
+                with recorder._lock:
+                    recorder.injected_errors += 1
+                self._respond(error_status, b'{"error":"injected"}')
+                return
+
+            recorder.record(self.path, len(raw), body, compressed, time.perf_counter() - start)
+            self._respond(202, b'')
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/stats':
+                self._respond(200, json.dumps(recorder.stats()).encode('utf-8'))
+            else:
+                self._respond(404, b'')
+
+        def _respond(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return EventsHandler
+
+
+def start_server(host='127.0.0.1', port=0, delay_ms=0, error_rate=0.0, error_status=503):
+    """Start the mock endpoint on a background thread; returns (server, recorder, events_uri)."""
+    recorder = EventsRecorder()
+    server = ThreadingHTTPServer((host, port), make_handler(recorder, delay_ms, error_rate, error_status))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-events-server', daemon=True).start()
+    return server, recorder, f"http://{host}:{server.server_address[1]}"
+
+
+FLUSH_POLICIES = {
+    # name: (Config overrides, flush after every user)
+    'per-user-flush': ({}, True),
+    'interval-5s': ({'flush_interval': 5}, False),
+    'interval-1s': ({'flush_interval': 1}, False),
+    'interval-5s-gzip': ({'flush_interval': 5, 'enable_event_compression': True}, False),
+}
+
+
+def run_benchmark(users, policies, delay_ms=0, error_rate=0.0):
+    """Drive simulate_user_journey_v2 through an offline LDClient for each flush policy."""
+    from ldclient.client import LDClient
+    from ldclient.config import Config
+    from ldclient.integrations.test_data import TestData
+    from gravityfarms_simulation import simulate_user_journey_v2
+
+    td = TestData.data_source()
+    td.update(td.flag('number-of-days-trial').variations(7, 14, 30).fallthrough_variation(0))
+    td.update(td.flag('seasonal-sale-banner-text').variations('', 'Fall Sale!').fallthrough_variation(1))
+    td.update(td.flag('hero-banner-text').variations(
+        {'banner-text': 'Control'}, {'banner-text': 'Top-Rated'}, {'banner-text': 'Next Generation'}
+    ).fallthrough_variation(2))
+
+    results = {}
+    for name in policies:
+        overrides, flush_each_user = FLUSH_POLICIES[name]
+        server, recorder, events_uri = start_server(delay_ms=delay_ms, error_rate=error_rate)
+        client = LDClient(config=Config(
+            'bench-sdk-key', update_processor_class=td, events_uri=events_uri,
+            diagnostic_opt_out=True, **overrides
+        ))
+        start = time.perf_counter()
+        for _ in range(users):
+            simulate_user_journey_v2(
+                client, None, mode='launchdarkly', assignment_log_path=None,
+                flush_each_user=flush_each_user
+            )
+        loop_seconds = time.perf_counter() - start
+        client.close()
+        total_seconds = time.perf_counter() - start
+        server.shutdown()
+        stats = recorder.stats()
+        stats.update(loop_seconds=loop_seconds, total_seconds=total_seconds)
+        results[name] = stats
+
+    print(f"{'Policy':<18} {'Users/s':>9} {'Payloads':>9} {'Events':>8} {'Ev/payload':>10} "
+          f"{'Wire KB':>9} {'Ratio':>6} {'Age p50 ms':>11} {'Age p99 ms':>11}")
+    for name, s in results.items():
+        print(f"{name:<18} {users / s['loop_seconds']:>9.0f} {s['payloads']:>9} {s['events']:>8} "
+              f"{(s['events_per_payload_mean'] or 0):>10.1f} {s['wire_bytes'] / 1024:>9.1f} "
+              f"{(s['compression_ratio'] or 0):>6.2f} {(s['event_age_ms_p50'] or 0):>11.0f} "
+              f"{(s['event_age_ms_p99'] or 0):>11.0f}")
+    return results
+
+
+def main():
+    configure_logging()
+    parser = argparse.ArgumentParser(description='Local LaunchDarkly events endpoint for throughput testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--delay-ms', type=float, default=0, help='Delay every response by this many ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of payloads answered with a 5xx')
+    parser.add_argument('--error-status', type=int, default=503, help='Status code for injected errors')
+    parser.add_argument('--benchmark', action='store_true', help='Run the offline flush-policy benchmark and exit')
+    parser.add_argument('--users', type=int, default=2000, help='Users per benchmark policy')
+    parser.add_argument('--policies', default=','.join(FLUSH_POLICIES), help='Comma-separated flush policies to benchmark')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.users, args.policies.split(','), args.delay_ms, args.error_rate)
+        return 0
+
+    server, recorder, events_uri = start_server(args.host, args.port, args.delay_ms, args.error_rate, args.error_status)
+    logger.info(f"Mock events endpoint listening on {events_uri} (stats at {events_uri}/stats)")
+    try:
+        while True:
+            time.sleep(10)
+            s = recorder.stats()
+            logger.info(f"{s['payloads']} payloads, {s['events']} events, "
+                        f"{s['events_per_second']:.1f} events/s, {s['injected_errors']} injected errors")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        logger.info(f"Final stats: {json.dumps(recorder.stats())}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
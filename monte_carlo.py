@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Vectorized Monte Carlo dry run of the hero banner experiment funnel.
+
+Draws variant assignment and user attributes for N users with NumPy arrays
+and walks them through the compiled hero banner funnel's transition
+matrices (funnel_engine.FunnelModel.run_batch), without per-user Python or
+LaunchDarkly calls. A validation mode replays a
+sample through simulate_user_journey_v2 with an offline flag client and
+compares the two paths statistically.
+"""
+
+import math
+import time
+import random
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+from gravityfarms_simulation import (
+    COUNTRIES, PLAN_TYPES, HERO_BANNER_MODEL, get_faker, hero_banner_variant, simulate_user_journey_v2
+)
+
+logger = logging.getLogger('gravityfarms-simulation')
+
+VARIANTS = list(HERO_BANNER_MODEL.variants)
+
+# Hero banner flag values whose banner text maps back to each variant
+VARIANT_FLAG_VALUES = {
+    "Control": {"banner-text": "Control"},
+    "Variant 1": {"banner-text": "Top-Rated Fresh Food"},
+    "Next Generation": {"banner-text": "Next Generation Nutrition"},
+}
+
+SUM_FIELDS = ["users", "signups", "paid", "revenue", "revenue_sq", "adjusted", "adjusted_sq",
+              "banner_clicks", "hero_engagements"]
+
+
+def parse_weights(spec, cast=str):
+    """Parse 'a=1,b=2' into {cast(a): 1.0, cast(b): 2.0}."""
+    weights = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        key, _, weight = part.partition('=')
+        weights[cast(key.strip())] = float(weight) if weight else 1.0
+    return weights
+
+
+def _normalized(weights):
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("Weights must sum to a positive value")
+    return np.array([w / total for w in weights.values()])
+
+
+def simulate_funnel_vectorized(n_users, variant_weights, trial_days_weights,
+                               seasonal_banner_share=1.0, seed=None, chunk_size=1_000_000):
+    """Draw the funnel for n_users in chunks and return per-variant sums."""
+    rng = np.random.default_rng(seed)
+    variant_p = _normalized({v: variant_weights.get(v, 0.0) for v in VARIANTS})
+    trial_days_values = np.array(list(trial_days_weights), dtype=np.float64)
+    trial_days_p = _normalized(trial_days_weights)
+
+    model = HERO_BANNER_MODEL
+    # Region and price tables indexed by country / [plan, country]; generate_user_context samples both uniformly
+    country_region = np.array([model.region_index(model.region_of(country)) for country in COUNTRIES])
+    prices = np.array([[model.monthly_price(plan, country) for country in COUNTRIES] for plan in PLAN_TYPES])
+
+    k = len(VARIANTS)
+    totals = {field: np.zeros(k) for field in SUM_FIELDS}
+    remaining = n_users
+    while remaining > 0:
+        n = min(chunk_size, remaining)
+        remaining -= n
+
+        variant = rng.choice(k, size=n, p=variant_p)
+        country = rng.integers(len(COUNTRIES), size=n)
+        attributes = {
+            "seasonal_banner": rng.random(n) < seasonal_banner_share,
+            "trial_days": trial_days_values[rng.choice(len(trial_days_values), size=n, p=trial_days_p)],
+            "monthly_price": prices[rng.integers(len(PLAN_TYPES), size=n), country],
+        }
+        outcome = model.run_batch(variant, country_region[country], attributes, rng)
+
+        paid = outcome["trial_to_paid_conversion"][0]
+        paid_variant = variant[paid]
+        revenue = outcome["total_revenue"][1][paid]
+        adjusted = outcome["adjusted_revenue"][1][paid]
+
+        totals["users"] += np.bincount(variant, minlength=k)
+        totals["signups"] += np.bincount(variant, weights=outcome["trial_signup"][0], minlength=k)
+        totals["paid"] += np.bincount(paid_variant, minlength=k)
+        totals["revenue"] += np.bincount(paid_variant, weights=revenue, minlength=k)
+        totals["revenue_sq"] += np.bincount(paid_variant, weights=revenue * revenue, minlength=k)
+        totals["adjusted"] += np.bincount(paid_variant, weights=adjusted, minlength=k)
+        totals["adjusted_sq"] += np.bincount(paid_variant, weights=adjusted * adjusted, minlength=k)
+        totals["banner_clicks"] += np.bincount(variant, weights=outcome["banner_click"][0], minlength=k)
+        totals["hero_engagements"] += np.bincount(variant, weights=outcome["hero_engagement"][0], minlength=k)
+
+    return {v: {field: float(totals[field][i]) for field in SUM_FIELDS} for i, v in enumerate(VARIANTS)}
+
+
+class _Detail:
+    def __init__(self, value, variation_index):
+        self.value = value
+        self.variation_index = variation_index
+        self.reason = {"kind": "OFFLINE_DRY_RUN"}
+
+    def __str__(self):
+        return f"EvaluationDetail(value={self.value}, variation_index={self.variation_index})"
+
+
+class _OfflineFlagsState:
+    """Minimal FeatureFlagsState: the parts flag_snapshot.FlagSnapshot.from_state reads."""
+
+    valid = True
+
+    def __init__(self, details):
+        self.details = details
+
+    def to_values_map(self):
+        return {key: detail.value for key, detail in self.details.items()}
+
+    def to_json_dict(self):
+        flags_state = {
+            key: {"variation": detail.variation_index, "reason": detail.reason}
+            for key, detail in self.details.items()
+        }
+        return {**self.to_values_map(), "$flagsState": flags_state, "$valid": True}
+
+
+class OfflineFlagClient:
+    """Stand-in for LDClient that assigns variations by weight without any network calls."""
+
+    def __init__(self, variant_weights, trial_days_weights, seasonal_banner_share=1.0):
+        self.variant_weights = variant_weights
+        self.trial_days_weights = trial_days_weights
+        self.seasonal_banner_share = seasonal_banner_share
+
+    def variation_detail(self, key, context, default):
+        if key == 'hero-banner-text':
+            variant = random.choices(VARIANTS, weights=[self.variant_weights.get(v, 0.0) for v in VARIANTS])[0]
+            return _Detail(VARIANT_FLAG_VALUES[variant], VARIANTS.index(variant))
+        if key == 'number-of-days-trial':
+            days = list(self.trial_days_weights)
+            value = random.choices(days, weights=list(self.trial_days_weights.values()))[0]
+            return _Detail(value, days.index(value))
+        return _Detail(default, None)
+
+    def variation(self, key, context, default):
+        if key == 'seasonal-sale-banner-text':
+            return "Dry Run Sale" if random.random() < self.seasonal_banner_share else ""
+        return self.variation_detail(key, context, default).value
+
+    def all_flags_state(self, context, **kwargs):
+        """Evaluate every flag this client serves, for --flag-evaluation snapshot."""
+        seasonal = self.variation('seasonal-sale-banner-text', context, "")
+        return _OfflineFlagsState({
+            'hero-banner-text': self.variation_detail('hero-banner-text', context, None),
+            'number-of-days-trial': self.variation_detail('number-of-days-trial', context, None),
+            'seasonal-sale-banner-text': _Detail(seasonal, 0 if seasonal else 1),
+        })
+
+    def track(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+
+def simulate_funnel_per_user(n_users, variant_weights, trial_days_weights, seasonal_banner_share=1.0):
+    """Run n_users through simulate_user_journey_v2 offline and return per-variant sums."""
+    client = OfflineFlagClient(variant_weights, trial_days_weights, seasonal_banner_share)
+    fake = get_faker()
+    totals = {v: defaultdict(float) for v in VARIANTS}
+    for _ in range(n_users):
+        user_info, flag_values, events, snowflake_events = simulate_user_journey_v2(
+            client, fake, mode='snowflake', assignment_log_path=None
+        )
+        t = totals[hero_banner_variant(flag_values['heroBanner'])]
+        t["users"] += 1
+        t["signups"] += "trial_signup" in events
+        t["paid"] += "trial_to_paid_conversion" in events
+        t["banner_clicks"] += "banner_click" in events
+        t["hero_engagements"] += "hero_engagement" in events
+        for event_data in snowflake_events:
+            if event_data['event_key'] == 'total_revenue':
+                t["revenue"] += event_data['event_value']
+                t["revenue_sq"] += event_data['event_value'] ** 2
+            elif event_data['event_key'] == 'adjusted_revenue':
+                t["adjusted"] += event_data['event_value']
+                t["adjusted_sq"] += event_data['event_value'] ** 2
+    return {v: {field: totals[v][field] for field in SUM_FIELDS} for v in VARIANTS}
+
+
+def summarize(totals):
+    """Turn per-variant sums into rates and means."""
+    summary = {}
+    for variant, t in totals.items():
+        users, paid = t["users"], t["paid"]
+        summary[variant] = {
+            "users": int(users),
+            "signup_rate": t["signups"] / users if users else 0.0,
+            "paid_rate": paid / users if users else 0.0,
+            "revenue_mean": t["revenue"] / paid if paid else 0.0,
+            "adjusted_mean": t["adjusted"] / paid if paid else 0.0,
+            "revenue_per_user": t["revenue"] / users if users else 0.0,
+            "banner_click_rate": t["banner_clicks"] / users if users else 0.0,
+            "hero_engagement_rate": t["hero_engagements"] / users if users else 0.0,
+        }
+    return summary
+
+
+def _z_proportion(x1, n1, x2, n2):
+    if not n1 or not n2:
+        return 0.0
+    pooled = (x1 + x2) / (n1 + n2)
+    se = math.sqrt(pooled * (1 - pooled) * (1 / n1 + 1 / n2))
+    return (x1 / n1 - x2 / n2) / se if se > 0 else 0.0
+
+
+def _z_mean(s1, sq1, n1, s2, sq2, n2):
+    if n1 < 2 or n2 < 2:
+        return 0.0
+    m1, m2 = s1 / n1, s2 / n2
+    v1 = max(0.0, (sq1 - n1 * m1 * m1) / (n1 - 1))
+    v2 = max(0.0, (sq2 - n2 * m2 * m2) / (n2 - 1))
+    se = math.sqrt(v1 / n1 + v2 / n2)
+    return (m1 - m2) / se if se > 0 else 0.0
+
+
+def compare_paths(vectorized, per_user, z_threshold=3.5):
+    """Compare vectorized and per-user sums with z-tests; returns (rows, all_consistent)."""
+    rows = []
+    consistent = True
+    for variant in VARIANTS:
+        a, b = vectorized[variant], per_user[variant]
+        checks = [
+            ("assignment", _z_proportion(a["users"], sum(t["users"] for t in vectorized.values()),
+                                         b["users"], sum(t["users"] for t in per_user.values()))),
+            ("signup_rate", _z_proportion(a["signups"], a["users"], b["signups"], b["users"])),
+            ("paid_rate", _z_proportion(a["paid"], a["users"], b["paid"], b["users"])),
+            ("revenue_mean", _z_mean(a["revenue"], a["revenue_sq"], a["paid"],
+                                     b["revenue"], b["revenue_sq"], b["paid"])),
+            ("adjusted_mean", _z_mean(a["adjusted"], a["adjusted_sq"], a["paid"],
+                                      b["adjusted"], b["adjusted_sq"], b["paid"])),
+            ("banner_click_rate", _z_proportion(a["banner_clicks"], a["users"], b["banner_clicks"], b["users"])),
+            ("hero_engagement_rate", _z_proportion(a["hero_engagements"], a["users"],
+                                                   b["hero_engagements"], b["users"])),
+        ]
+        for metric, z in checks:
+            ok = abs(z) < z_threshold
+            consistent = consistent and ok
+            rows.append((variant, metric, z, ok))
+    return rows, consistent
+
+
+def run_dry_run(n_users, variant_weights, trial_days_weights, seasonal_banner_share=1.0,
+                seed=None, validate_users=0):
+    """Run the vectorized dry run, print expected per-variant metrics and optionally validate."""
+    start = time.perf_counter()
+    totals = simulate_funnel_vectorized(n_users, variant_weights, trial_days_weights,
+                                        seasonal_banner_share, seed=seed)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Dry run: {n_users:,} users in {elapsed:.2f}s ({n_users / elapsed:,.0f} users/s)")
+
+    print(f"{'Variant':<16} {'Users':>12} {'Signup':>8} {'Paid':>8} {'Rev/paid':>9} "
+          f"{'Adj/paid':>9} {'Rev/user':>9} {'Banner':>8} {'Hero':>8}")
+    for variant, m in summarize(totals).items():
+        print(f"{variant:<16} {m['users']:>12,} {m['signup_rate']:>8.4f} {m['paid_rate']:>8.4f} "
+              f"{m['revenue_mean']:>9.2f} {m['adjusted_mean']:>9.2f} {m['revenue_per_user']:>9.4f} "
+              f"{m['banner_click_rate']:>8.4f} {m['hero_engagement_rate']:>8.4f}")
+
+    if validate_users:
+        if seed is not None:
+            random.seed(seed)
+        start = time.perf_counter()
+        per_user = simulate_funnel_per_user(validate_users, variant_weights, trial_days_weights,
+                                            seasonal_banner_share)
+        elapsed = time.perf_counter() - start
+        logger.info(f"Per-user validation: {validate_users:,} users in {elapsed:.2f}s")
+        rows, consistent = compare_paths(totals, per_user)
+        for variant, metric, z, ok in rows:
+            print(f"   {'✅' if ok else '❌'} {variant:<16} {metric:<22} z={z:+.2f}")
+        print("Vectorized and per-user paths agree." if consistent
+              else "Vectorized and per-user paths DIFFER beyond the z threshold.")
+        return 0 if consistent else 1
+    return 0
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Startup Time Profiler
+
+Reports where import and initialization time is spent for the simulation
+modules. Each measurement runs in a fresh interpreter so module caches from
+one step do not hide the cost of the next.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+# Lazily-loaded dependencies and the statement that pays their init cost
+INIT_STEPS = [
+    ("faker import", "import faker"),
+    ("Faker() construction", "from gravityfarms_simulation import get_faker; get_faker()"),
+    ("ldclient import", "import ldclient"),
+    ("ldclient Context build", "from gravityfarms_simulation import generate_user_context; generate_user_context()"),
+    ("snowflake.connector import", "import snowflake.connector"),
+    ("dotenv load", "from dotenv import load_dotenv; load_dotenv()"),
+]
+
+TIMER_TEMPLATE = """
+import time
+_t0 = time.perf_counter()
+{statement}
+print(time.perf_counter() - _t0)
+"""
+
+def run_python(code, importtime=False):
+    """Run code in a fresh interpreter from the repository directory."""
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    cmd += ['-c', code]
+    return subprocess.run(
+        cmd, capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+
+def parse_importtime(stderr):
+    """Parse `-X importtime` output into (module, self_us, cumulative_us, depth) rows."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        except ValueError:
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+def profile_import(module, top):
+    """Print the total import cost of module and its most expensive imports."""
+    result = run_python(f"import {module}", importtime=True)
+    if result.returncode != 0:
+        print(f"❌ import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+        return
+    rows = parse_importtime(result.stderr)
+    total = next((cum for name, _, cum, _ in rows if name == module), 0)
+    print(f"\n📦 import {module}: {total / 1000:.1f} ms")
+    print(f"   {'cumulative':>12} {'self':>10}  module")
+    for name, self_us, cumulative_us, depth in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+        print(f"   {cumulative_us / 1000:>9.1f} ms {self_us / 1000:>7.1f} ms  {'  ' * depth}{name}")
+
+def profile_init_steps():
+    """Print the wall time of each lazily-loaded dependency's first use."""
+    print("\n⏱️  Deferred initialization (first use)")
+    for label, statement in INIT_STEPS:
+        result = run_python(TIMER_TEMPLATE.format(statement=statement))
+        if result.returncode != 0:
+            print(f"   {'n/a':>12}  {label} (unavailable)")
+            continue
+        seconds = float(result.stdout.strip().splitlines()[-1])
+        print(f"   {seconds * 1000:>9.1f} ms  {label}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Report import and initialization time for the simulation modules')
+    parser.add_argument('--module', action='append',
+                        help='Module to profile (repeatable, default: all simulation entry points)')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to list per module')
+    parser.add_argument('--skip-init', action='store_true', help='Only report import time')
+    args = parser.parse_args()
+
+    modules = args.module or ['gravityfarms_simulation', 'run_continuous_simulation', 'simulate_ld_data']
+    print("🚀 Startup profile")
+    for module in modules:
+        profile_import(module, args.top)
+    if not args.skip_init:
+        profile_init_steps()
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Resource telemetry for long-running simulations.
+
+Samples RSS, open file descriptors, thread count and (optionally) the top
+tracemalloc allocation diffs between samples, appends them as JSON lines to
+a rotating metrics file, and warns when growth since the baseline sample
+passes configured thresholds. A heap snapshot can be dumped on demand by
+sending SIGUSR1 to the process.
+"""
+
+import os
+import sys
+import json
+import signal
+import logging
+import threading
+import tracemalloc
+import logging.handlers
+from datetime import datetime
+
+logger = logging.getLogger('gravityfarms-resources')
+
+
+def current_rss_bytes():
+    """Resident set size of this process, or None if it cannot be determined."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    import resource
+    # ru_maxrss is the peak, in KiB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def open_fd_count():
+    """Number of open file descriptors, or None on platforms without /proc or /dev/fd."""
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            continue
+    return None
+
+
+def os_thread_count():
+    """OS-level thread count (includes threads not started from Python)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return threading.active_count()
+
+
+class ResourceMonitor:
+    """Periodic resource samples with growth alerts and on-demand heap snapshots."""
+
+    def __init__(self, metrics_path='resource_metrics.jsonl', max_bytes=10 * 1024 * 1024,
+                 backup_count=5, trace_allocations=False, top_allocations=10,
+                 rss_growth_alert_mb=200, fd_growth_alert=50, thread_growth_alert=20,
+                 snapshot_dir='.'):
+        self.trace_allocations = trace_allocations
+        self.top_allocations = top_allocations
+        self.rss_growth_alert_mb = rss_growth_alert_mb
+        self.fd_growth_alert = fd_growth_alert
+        self.thread_growth_alert = thread_growth_alert
+        self.snapshot_dir = snapshot_dir
+
+        self._metrics_logger = logging.getLogger(f'gravityfarms-resources.metrics.{id(self)}')
+        self._metrics_logger.propagate = False
+        self._metrics_logger.setLevel(logging.INFO)
+        self._handler = logging.handlers.RotatingFileHandler(
+            metrics_path, maxBytes=max_bytes, backupCount=backup_count
+        )
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._metrics_logger.addHandler(self._handler)
+
+        self._baseline = None
+        self._last_snapshot = None
+        self.samples = 0
+        # sample() is called from both the batch loop and PeriodicSampler
+        self._lock = threading.Lock()
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+
+    def sample(self, label=None):
+        """Take one sample, write it to the metrics file and return it."""
+        with self._lock:
+            return self._sample(label)
+
+    def _sample(self, label):
+        record = {
+            'timestamp': datetime.now().isoformat(),
+            'label': label,
+            'rss_bytes': current_rss_bytes(),
+            'open_fds': open_fd_count(),
+            'threads': os_thread_count(),
+            'python_threads': threading.active_count(),
+        }
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            current, peak = tracemalloc.get_traced_memory()
+            record['traced_bytes'] = current
+            record['traced_peak_bytes'] = peak
+            if self._last_snapshot is not None:
+                record['top_allocation_diffs'] = [
+                    {'location': str(stat.traceback[0]), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff}
+                    for stat in snapshot.compare_to(self._last_snapshot, 'lineno')[:self.top_allocations]
+                ]
+            self._last_snapshot = snapshot
+
+        if self._baseline is None:
+            self._baseline = record
+        else:
+            record['alerts'] = self._check_growth(record)
+        self.samples += 1
+        self._metrics_logger.info(json.dumps(record))
+        return record
+
+    def _check_growth(self, record):
+        alerts = []
+        base = self._baseline
+        if record['rss_bytes'] is not None and base['rss_bytes'] is not None:
+            growth_mb = (record['rss_bytes'] - base['rss_bytes']) / (1024 * 1024)
+            if growth_mb > self.rss_growth_alert_mb:
+                alerts.append(f"RSS grew {growth_mb:.1f} MB since baseline")
+        if record['open_fds'] is not None and base['open_fds'] is not None:
+            growth = record['open_fds'] - base['open_fds']
+            if growth > self.fd_growth_alert:
+                alerts.append(f"open file descriptors grew by {growth}")
+        growth = record['threads'] - base['threads']
+        if growth > self.thread_growth_alert:
+            alerts.append(f"thread count grew by {growth}")
+        for alert in alerts:
+            logger.warning(f"Resource alert: {alert}")
+        return alerts
+
+    def dump_heap_snapshot(self):
+        """Write a tracemalloc snapshot to disk; starts tracing if it was off."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            logger.warning("tracemalloc was not running; started it, send the signal again for a snapshot")
+            return None
+        path = os.path.join(self.snapshot_dir, f"heap_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.tracemalloc")
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(path)
+        logger.info(f"Heap snapshot written to {path} (load with tracemalloc.Snapshot.load)")
+        for stat in snapshot.statistics('lineno')[:self.top_allocations]:
+            logger.info(f"   {stat}")
+        return path
+
+    def install_signal_handler(self, signum=None):
+        """Dump a heap snapshot whenever signum (default SIGUSR1) is received."""
+        signum = signum or getattr(signal, 'SIGUSR1', None)
+        if signum is None:
+            logger.warning("SIGUSR1 is not available on this platform; heap snapshots on signal are disabled")
+            return
+        signal.signal(signum, lambda s, f: self.dump_heap_snapshot())
+
+    def close(self):
+        self._metrics_logger.removeHandler(self._handler)
+        self._handler.close()
+
+
+class PeriodicSampler(threading.Thread):
+    """Background thread that samples a ResourceMonitor every interval seconds."""
+
+    def __init__(self, monitor, interval=60.0):
+        super().__init__(name='resource-sampler', daemon=True)
+        self.monitor = monitor
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.monitor.sample(label='periodic')
+
+    def stop(self):
+        self._stop_event.set()
@@ -12,11 +12,17 @@ import random
 import signal
 import sys
 import argparse
-from gravityfarms_simulation import simulate_user_journey_v2, generate_user_context, get_snowflake_connection
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import gravityfarms_simulation
+from gravityfarms_simulation import simulate_user_journey_v2, generate_user_context, get_snowflake_connection, get_faker, configure_logging, hero_banner_variant
+from gravityfarms_simulation import insert_metric_event_to_snowflake, is_permanent_snowflake_error
+from metric_spool import MetricEventSpool
 from ldclient import LDClient, Config, Context
-from faker import Faker
-from collections import defaultdict
+from collections import defaultdict, deque
 import os
+from resource_monitor import ResourceMonitor, PeriodicSampler
+from stage_profiler import SimulationProfiler, add_profile_arguments
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -110,16 +116,165 @@ def log_status(iteration, start_time, duration, records_per_second, traffic_mult
     print(f"   Total elapsed: {elapsed}")
     print(f"   Estimated users this batch: {int(duration * records_per_second)}")
 
-def run_simulation(duration, records_per_second, mode='launchdarkly'):
-    """Run simulation with interruption checking"""
+class JourneyWorkerPool:
+    """
+    Thread pool for I/O-bound journeys (polling / relay-proxy LD clients, Snowflake writes).
+
+    Each worker thread gets its own random.Random and Faker, seeded from
+    seed + worker index, so no generator state is shared between threads.
+    The pool is created once and reused for every batch, so each worker's
+    stream continues across batches instead of replaying from the seed.
+    Per-worker counters are only written by their own thread; the batch
+    results are aggregated on the submitting thread as futures complete.
+    """
+
+    def __init__(self, workers, seed=None, assignment_log_path="experiment_assignments.jsonl"):
+        self.workers = workers
+        self.seed = seed
+        # None skips the assignment log (benchmarks must not add synthetic users to it)
+        self.assignment_log_path = assignment_log_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.worker_stats = []
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='journey',
+                                           initializer=self._init_worker)
+
+    def _init_worker(self):
+        from faker import Faker
+        with self._lock:
+            index = len(self.worker_stats)
+            stats = {'worker': index, 'users': 0, 'busySeconds': 0.0, 'errors': 0}
+            self.worker_stats.append(stats)
+        worker_seed = None if self.seed is None else self.seed + index
+        fake = Faker()
+        if worker_seed is not None:
+            fake.seed_instance(worker_seed)
+        self._local.rng = random.Random(worker_seed)
+        self._local.fake = fake
+        self._local.stats = stats
+
+    def _run_journey(self, ld_client, mode, snowflake_conn, metric_sink):
+        local = self._local
+        start = time.perf_counter()
+        try:
+            journey = simulate_user_journey_v2(
+                ld_client, local.fake, mode=mode, snowflake_conn=snowflake_conn,
+                assignment_log_path=self.assignment_log_path, rng=local.rng
+            )
+            if metric_sink:
+                for event_data in journey[3]:
+                    metric_sink(event_data)
+            return journey
+        except Exception:
+            local.stats['errors'] += 1
+            raise
+        finally:
+            local.stats['users'] += 1
+            local.stats['busySeconds'] += time.perf_counter() - start
+
+    def submit(self, ld_client, mode='launchdarkly', snowflake_conn=None, metric_sink=None):
+        return self.executor.submit(self._run_journey, ld_client, mode, snowflake_conn, metric_sink)
+
+    def reset_stats(self):
+        """Zero the per-worker counters between batches (no journeys may be in flight)."""
+        for stats in self.worker_stats:
+            stats.update(users=0, busySeconds=0.0, errors=0)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def print_worker_stats(self, wall_seconds):
+        for stats in sorted(self.worker_stats, key=lambda s: s['worker']):
+            busy = stats['busySeconds'] / wall_seconds * 100 if wall_seconds else 0.0
+            print(f"   worker {stats['worker']}: {stats['users']} users, {busy:.0f}% busy, {stats['errors']} errors")
+
+def record_journey(results, mode, journey):
+    """Add one journey's flag values and events to the batch results."""
+    user_info, flag_values, events, snowflake_events = journey
+    results["totalUsers"] += 1
+    for event in events:
+        results["events"][event] += 1
+    for flag, value in flag_values.items():
+        value_str = str(value)
+        results["flagEvaluations"][flag][value_str] += 1
+    if mode == 'snowflake' and snowflake_events:
+        results["snowflakeEvents"] += len(snowflake_events)
+
+def run_journeys_concurrently(pool, ld_client, total_records, records_per_second, results,
+                              mode='launchdarkly', snowflake_conn=None, ordered=False, metric_sink=None):
+    """
+    Run total_records journeys on the pool, at most records_per_second per second
+    (None for unthrottled). Workers pass each journey's Snowflake metric events
+    to metric_sink. At most 2 x workers journeys are in flight; with
+    ordered=True results are recorded in submission order, otherwise as they
+    complete. When running goes False no more journeys are submitted and the
+    in-flight ones are drained before returning. Returns the number completed.
+    """
+    window = pool.workers * 2
+    pending = deque() if ordered else set()
+    completed = 0
+    submitted = 0
+    second_start = time.monotonic()
+
+    def collect(future):
+        nonlocal completed
+        try:
+            record_journey(results, mode, future.result())
+        except Exception as e:
+            print(f"   ❌ Journey failed: {e}")
+        completed += 1
+        if records_per_second and completed % records_per_second == 0:
+            print(f"Progress: {completed}/{total_records} users ({(completed / total_records) * 100:.1f}%)")
+
+    def drain_one():
+        if ordered:
+            collect(pending.popleft())
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                collect(future)
+
+    while submitted < total_records:
+        if not running:
+            print(f"\n⏹️  Simulation interrupted at {submitted}/{total_records} users; "
+                  f"draining {len(pending)} in-flight journeys")
+            break
+        while len(pending) >= window:
+            drain_one()
+        future = pool.submit(ld_client, mode=mode, snowflake_conn=snowflake_conn, metric_sink=metric_sink)
+        if ordered:
+            pending.append(future)
+        else:
+            pending.add(future)
+        submitted += 1
+        if records_per_second and submitted % records_per_second == 0:
+            # Same pacing as the sequential loop, minus the time the batch already took
+            remaining = 1.0 - (time.monotonic() - second_start)
+            if remaining > 0:
+                time.sleep(remaining)
+            second_start = time.monotonic()
+
+    while pending:
+        drain_one()
+    return completed
+
+def run_simulation(duration, records_per_second, mode='launchdarkly', events_uri=None, profiler=None,
+                   pool=None, ordered=False, spool_dir='metric_spool', spool_drain_timeout=30.0,
+                   spool_max_attempts=3):
+    """Run simulation with interruption checking; a JourneyWorkerPool runs journeys on its threads"""
     global running
     
     LD_SDK_KEY = os.getenv("LAUNCHDARKLY_SDK_KEY", "YOUR_SDK_KEY")
-    fake = Faker()
-    ldclient = LDClient(Config(sdk_key=LD_SDK_KEY))
+    fake = get_faker()
+    events_config = {'events_uri': events_uri} if events_uri else {}
+    ldclient = LDClient(Config(sdk_key=LD_SDK_KEY, **events_config))
+    if profiler:
+        profiler.instrument_client(ldclient)
     
     # Initialize Snowflake connection if needed
     snowflake_conn = None
+    spool = None
     if mode == 'snowflake':
         try:
             snowflake_conn = get_snowflake_connection()
@@ -127,6 +282,12 @@ def run_simulation(duration, records_per_second, mode='launchdarkly'):
         except Exception as e:
             print(f"   ❌ Failed to connect to Snowflake: {e}")
             return
+        # Journeys append to the durable spool; its single drain thread owns the connection
+        spool = MetricEventSpool(
+            spool_dir, lambda event_data: insert_metric_event_to_snowflake(snowflake_conn, event_data),
+            max_attempts=spool_max_attempts, permanent_error=is_permanent_snowflake_error
+        )
+    metric_sink = spool.append if spool else None
     
     total_records = duration * records_per_second
     results = {
@@ -135,30 +296,32 @@ def run_simulation(duration, records_per_second, mode='launchdarkly'):
         "flagEvaluations": defaultdict(lambda: defaultdict(int)),
         "snowflakeEvents": 0 if mode == 'snowflake' else None
     }
+    if pool:
+        pool.reset_stats()
+    batch_start = time.perf_counter()
     
     try:
-        for i in range(total_records):
-            # Check if we should stop
-            if not running:
-                print(f"\n⏹️  Simulation interrupted at {i + 1}/{total_records} users")
-                break
+        if pool:
+            print(f"   🧵 Running journeys on {pool.workers} worker threads ({'ordered' if ordered else 'unordered'} completion)")
+            run_journeys_concurrently(pool, ldclient, total_records, records_per_second, results,
+                                      mode=mode, snowflake_conn=snowflake_conn, ordered=ordered,
+                                      metric_sink=metric_sink)
+        else:
+            for i in range(total_records):
+                # Check if we should stop
+                if not running:
+                    print(f"\n⏹️  Simulation interrupted at {i + 1}/{total_records} users")
+                    break
+                    
+                journey = simulate_user_journey_v2(ldclient, fake, mode=mode, snowflake_conn=snowflake_conn)
+                if metric_sink:
+                    for event_data in journey[3]:
+                        metric_sink(event_data)
+                record_journey(results, mode, journey)
                 
-            user_info, flag_values, events, snowflake_events = simulate_user_journey_v2(
-                ldclient, fake, mode=mode, snowflake_conn=snowflake_conn
-            )
-            results["totalUsers"] += 1
-            for event in events:
-                results["events"][event] += 1
-            for flag, value in flag_values.items():
-                value_str = str(value)
-                results["flagEvaluations"][flag][value_str] += 1
-            
-            if mode == 'snowflake' and snowflake_events:
-                results["snowflakeEvents"] += len(snowflake_events)
-            
-            if (i + 1) % records_per_second == 0:
-                print(f"Progress: {i + 1}/{total_records} users ({((i + 1) / total_records) * 100:.1f}%)")
-                time.sleep(1)
+                if (i + 1) % records_per_second == 0:
+                    print(f"Progress: {i + 1}/{total_records} users ({((i + 1) / total_records) * 100:.1f}%)")
+                    time.sleep(1)
         
         if mode == 'launchdarkly':
             ldclient.flush()
@@ -170,14 +333,74 @@ def run_simulation(duration, records_per_second, mode='launchdarkly'):
             print("Events:", dict(results["events"]))
             print("Flag Evaluations:", {k: dict(v) for k, v in results["flagEvaluations"].items()})
             if mode == 'snowflake':
-                print(f"Snowflake Events Inserted: {results['snowflakeEvents']}")
+                print(f"Snowflake Events Spooled: {results['snowflakeEvents']}")
     
     finally:
+        if pool:
+            wall = time.perf_counter() - batch_start
+            print(f"   🧵 {results['totalUsers']} users in {wall:.1f}s ({results['totalUsers'] / wall:.1f} users/s)")
+            pool.print_worker_stats(wall)
         ldclient.close()
+        if spool:
+            # Undelivered events stay in spool_dir and are replayed by the next batch
+            spool.close(drain_timeout=spool_drain_timeout)
+            print(f"   📦 Metric event spool closed: {spool.stats()}")
         if snowflake_conn:
             snowflake_conn.close()
             print("   🔌 Snowflake connection closed")
 
+def benchmark_pool(pool_sizes, users, io_latency_ms=20.0, seed=0):
+    """
+    Measure unthrottled users/sec for each pool size against an offline client.
+
+    Flags come from TestData and events are counted rather than sent; each
+    per-user flush sleeps io_latency_ms to stand in for a network round trip,
+    which is where the pool earns its speedup. Nothing is written to the
+    assignment log.
+    """
+    from ldclient.integrations.test_data import TestData
+    from flag_snapshot import CountingEventProcessor
+
+    io_latency = io_latency_ms / 1000
+    print(f"Pool benchmark: {users} users per run, {io_latency_ms:.0f} ms simulated I/O per flush")
+    print(f"{'Workers':>8} {'Seconds':>8} {'Users/s':>9} {'Speedup':>8} {'Events':>8}  Variants")
+    baseline = None
+    for workers in pool_sizes:
+        td = TestData.data_source()
+        td.update(td.flag('number-of-days-trial').variations(3, 7, 14, 30).fallthrough_variation(1))
+        td.update(td.flag('seasonal-sale-banner-text').variations('', 'Spring Sale!').fallthrough_variation(1))
+        # Real banner-text values, split by country so every variant's funnel runs
+        td.update(td.flag('hero-banner-text').variations(
+            {'banner-text': 'Control Banner'}, {'banner-text': 'Top-Rated Variant'}, {'banner-text': 'Next Generation'}
+        ).if_match('country', 'US', 'UK').then_return(0)
+         .if_match('country', 'CA').then_return(1)
+         .fallthrough_variation(2))
+        events = CountingEventProcessor()
+        events.flush = lambda: time.sleep(io_latency)
+        client = LDClient(Config('bench-sdk-key', update_processor_class=td, diagnostic_opt_out=True,
+                                 event_processor_class=lambda config: events))
+        results = {
+            "totalUsers": 0,
+            "events": defaultdict(int),
+            "flagEvaluations": defaultdict(lambda: defaultdict(int)),
+            "snowflakeEvents": None
+        }
+        pool = JourneyWorkerPool(workers, seed=seed, assignment_log_path=None)
+        try:
+            start = time.perf_counter()
+            run_journeys_concurrently(pool, client, users, None, results)
+            elapsed = time.perf_counter() - start
+        finally:
+            pool.shutdown()
+            client.close()
+        rate = results['totalUsers'] / elapsed
+        baseline = baseline or rate
+        variants = defaultdict(int)
+        for value, count in results["flagEvaluations"]["heroBanner"].items():
+            variants[hero_banner_variant(value)] += count
+        print(f"{workers:>8} {elapsed:>8.2f} {rate:>9.1f} {rate / baseline:>7.2f}x {events.count:>8}  "
+              f"{dict(variants)}")
+
 def main():
     """Main function to run continuous simulation"""
     global running
@@ -186,7 +409,68 @@ def main():
     parser = argparse.ArgumentParser(description='Continuous LaunchDarkly Data Simulation')
     parser.add_argument('--mode', choices=['launchdarkly', 'snowflake'], 
                        default='launchdarkly', help='Simulation mode (launchdarkly or snowflake)')
+    parser.add_argument('--events-uri',
+                       help='LaunchDarkly events base URI (e.g. a local mock_events_server.py)')
+    parser.add_argument('--resource-metrics', default='resource_metrics.jsonl',
+                       help='Rotating JSONL file for RSS / fd / thread telemetry')
+    parser.add_argument('--resource-interval', type=float, default=60.0,
+                       help='Seconds between background resource samples (0 to sample only per batch)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                       help='Record top allocation diffs between samples (adds overhead)')
+    parser.add_argument('--rss-growth-alert-mb', type=float, default=200,
+                       help='Warn when RSS grows this many MB beyond the first sample')
+    parser.add_argument('--fd-growth-alert', type=int, default=50,
+                       help='Warn when open file descriptors grow by this many')
+    parser.add_argument('--thread-growth-alert', type=int, default=20,
+                       help='Warn when the thread count grows by this many')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Run journeys on this many threads (1 keeps the sequential loop)')
+    parser.add_argument('--ordered', action='store_true',
+                       help='With --workers, record results in submission order instead of completion order')
+    parser.add_argument('--seed', type=int,
+                       help='Seed per-worker RNG and Faker instances (worker i uses seed + i); streams continue across batches')
+    parser.add_argument('--spool-dir', default='metric_spool',
+                       help='Directory for the durable Snowflake metric event spool (--mode snowflake)')
+    parser.add_argument('--spool-drain-timeout', type=float, default=30.0,
+                       help='Seconds to wait for the spool to drain at the end of each batch')
+    parser.add_argument('--spool-max-attempts', type=int, default=3,
+                       help='Attempts before a metric event failing with a non-retryable error is moved to the spool dead-letter file')
+    parser.add_argument('--pool-benchmark', metavar='SIZES',
+                       help='Comma-separated pool sizes (e.g. 1,2,4,8): report users/sec for each offline and exit')
+    parser.add_argument('--benchmark-users', type=int, default=400,
+                       help='Users per pool size for --pool-benchmark')
+    parser.add_argument('--io-latency-ms', type=float, default=20.0,
+                       help='Simulated I/O latency per user flush for --pool-benchmark')
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    configure_logging()
+    
+    if args.pool_benchmark:
+        sizes = [int(size) for size in args.pool_benchmark.split(',')]
+        benchmark_pool(sizes, args.benchmark_users, args.io_latency_ms,
+                       seed=args.seed if args.seed is not None else 0)
+        return
+    
+    profiler = None
+    if args.profile:
+        profiler = SimulationProfiler(args.profile, args.profile_output, args.profile_interval_ms)
+        profiler.instrument_module(gravityfarms_simulation, gravityfarms_simulation.PROFILE_STAGES)
+        profiler.start()
+    
+    # Resource telemetry; send SIGUSR1 to dump a heap snapshot
+    resource_monitor = ResourceMonitor(
+        args.resource_metrics,
+        trace_allocations=args.tracemalloc,
+        rss_growth_alert_mb=args.rss_growth_alert_mb,
+        fd_growth_alert=args.fd_growth_alert,
+        thread_growth_alert=args.thread_growth_alert
+    )
+    resource_monitor.install_signal_handler()
+    resource_monitor.sample(label='startup')
+    sampler = None
+    if args.resource_interval > 0:
+        sampler = PeriodicSampler(resource_monitor, args.resource_interval)
+        sampler.start()
     
     # Set up signal handler for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
@@ -195,12 +479,16 @@ def main():
     print("🚀 Starting Continuous LaunchDarkly Data Simulation")
     print("=" * 60)
     print(f"Mode: {args.mode.upper()}")
+    if args.workers > 1:
+        print(f"Workers: {args.workers} ({'ordered' if args.ordered else 'unordered'} completion)")
     print("This script will run continuously with realistic traffic patterns.")
     print("Press Ctrl+C to stop gracefully.")
     print("=" * 60)
     
     start_time = datetime.datetime.now()
     iteration = 0
+    # One pool for the whole run: per-batch pools would replay the same seeded streams every batch
+    pool = JourneyWorkerPool(args.workers, seed=args.seed) if args.workers > 1 else None
     
     try:
         while running:
@@ -215,7 +503,15 @@ def main():
             
             # Run the simulation batch
             print(f"   Starting simulation batch...")
-            run_simulation(duration, records_per_second, mode=args.mode)
+            run_simulation(duration, records_per_second, mode=args.mode, events_uri=args.events_uri, profiler=profiler,
+                           pool=pool, ordered=args.ordered, spool_dir=args.spool_dir,
+                           spool_drain_timeout=args.spool_drain_timeout, spool_max_attempts=args.spool_max_attempts)
+            
+            sample = resource_monitor.sample(label=f'iteration {iteration}')
+            rss_mb = (sample['rss_bytes'] or 0) / (1024 * 1024)
+            print(f"   📈 RSS: {rss_mb:.1f} MB, open fds: {sample['open_fds']}, threads: {sample['threads']}")
+            for alert in sample.get('alerts', []):
+                print(f"   ⚠️  Resource alert: {alert}")
             
             # Add a small break between batches (30-90 seconds)
             if running:
@@ -228,6 +524,14 @@ def main():
     except Exception as e:
         print(f"\n❌ Error during simulation: {e}")
     finally:
+        if pool:
+            pool.shutdown()
+        if sampler:
+            sampler.stop()
+        resource_monitor.sample(label='shutdown')
+        resource_monitor.close()
+        if profiler:
+            profiler.stop()
         end_time = datetime.datetime.now()
         total_duration = end_time - start_time
         print(f"\n✅ Simulation completed!")
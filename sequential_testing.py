@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Sequential testing for simulation runs.
+
+Consumes per-user outcomes as they are simulated and keeps always-valid
+statistics for every variant-vs-control comparison using a normal-mixture
+sequential probability ratio test (mSPRT). The mSPRT yields p-values and
+confidence sequences that stay valid no matter how often they are checked,
+so a run can stop as soon as every comparison is decided.
+
+A comparison is decided when its confidence sequence excludes zero
+(significant) or lies entirely within +/- the minimum detectable effect
+(futile: any remaining difference is too small to matter).
+"""
+
+import math
+import logging
+
+logger = logging.getLogger('gravityfarms-simulation')
+
+METRICS = ('conversion', 'revenue')
+
+
+class RunningMoments:
+    """Welford running mean and variance."""
+
+    __slots__ = ('n', 'mean', 'm2')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+
+def msprt_statistic(diff, variance, tau_sq):
+    """Normal-mixture likelihood ratio for H0: diff == 0 given Var(diff) and mixing variance tau_sq."""
+    return math.sqrt(variance / (variance + tau_sq)) * \
+        math.exp(tau_sq * diff * diff / (2 * variance * (variance + tau_sq)))
+
+
+def msprt_half_width(variance, tau_sq, alpha):
+    """Half-width of the always-valid confidence sequence obtained by inverting the mSPRT."""
+    return math.sqrt(
+        2 * variance * (variance + tau_sq) / tau_sq *
+        (math.log(1 / alpha) + 0.5 * math.log((variance + tau_sq) / variance))
+    )
+
+
+class SequentialMonitor:
+    """Always-valid variant-vs-control comparisons for conversion and revenue per user."""
+
+    def __init__(self, variants, control='Control', alpha=0.05, mde=None,
+                 min_users_per_variant=100):
+        self.variants = list(variants)
+        self.control = control
+        self.treatments = [v for v in self.variants if v != control]
+        self.mde = {'conversion': 0.01, 'revenue': 0.5}
+        if mde:
+            self.mde.update(mde)
+        self.min_users_per_variant = min_users_per_variant
+        # Bonferroni correction across every comparison we may stop on
+        self.alpha = alpha / max(1, len(self.treatments) * len(METRICS))
+
+        self.moments = {v: {m: RunningMoments() for m in METRICS} for v in self.variants}
+        # Always-valid p-values are the running minimum of 1 / likelihood ratio
+        self.p_values = {(v, m): 1.0 for v in self.treatments for m in METRICS}
+        self.users = 0
+
+    def observe(self, variant, converted, revenue=0.0):
+        """Record one simulated user's outcome."""
+        if variant not in self.moments:
+            return
+        self.moments[variant]['conversion'].add(1.0 if converted else 0.0)
+        self.moments[variant]['revenue'].add(revenue or 0.0)
+        self.users += 1
+
+    def comparisons(self):
+        """Return the current state of every variant-vs-control comparison."""
+        results = []
+        for variant in self.treatments:
+            for metric in METRICS:
+                treatment = self.moments[variant][metric]
+                control = self.moments[self.control][metric]
+                result = {
+                    'variant': variant,
+                    'metric': metric,
+                    'n_variant': treatment.n,
+                    'n_control': control.n,
+                    'diff': treatment.mean - control.mean,
+                    'lower': None,
+                    'upper': None,
+                    'p_value': self.p_values[(variant, metric)],
+                    'state': 'undecided',
+                }
+                variance = (treatment.variance / treatment.n if treatment.n else 0.0) + \
+                    (control.variance / control.n if control.n else 0.0)
+                if min(treatment.n, control.n) >= self.min_users_per_variant and variance > 0:
+                    tau_sq = self.mde[metric] ** 2
+                    try:
+                        statistic = msprt_statistic(result['diff'], variance, tau_sq)
+                        p_value = min(self.p_values[(variant, metric)], 1 / statistic)
+                    except OverflowError:
+                        p_value = 0.0
+                    self.p_values[(variant, metric)] = p_value
+                    half_width = msprt_half_width(variance, tau_sq, self.alpha)
+                    result.update(
+                        p_value=p_value,
+                        lower=result['diff'] - half_width,
+                        upper=result['diff'] + half_width,
+                    )
+                    if p_value <= self.alpha:
+                        result['state'] = 'significant'
+                    elif -self.mde[metric] < result['lower'] and result['upper'] < self.mde[metric]:
+                        result['state'] = 'futile'
+                results.append(result)
+        return results
+
+    def should_stop(self):
+        """True once every comparison is significant or futile."""
+        return all(r['state'] != 'undecided' for r in self.comparisons())
+
+    def log_status(self, prefix="Sequential test"):
+        for r in self.comparisons():
+            interval = f"[{r['lower']:+.4f}, {r['upper']:+.4f}]" if r['lower'] is not None else "[n/a]"
+            logger.info(
+                f"{prefix}: {r['variant']} vs {self.control} {r['metric']}: "
+                f"diff={r['diff']:+.4f} CS={interval} p={r['p_value']:.4f} "
+                f"(n={r['n_variant']}/{r['n_control']}) -> {r['state']}"
+            )
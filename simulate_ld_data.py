@@ -1,4 +1,5 @@
 import argparse
+import sys
 import time
 import random
 from collections import defaultdict
@@ -7,6 +8,9 @@ from ldclient import LDClient, Config, Context
 import os
 from dotenv import load_dotenv
 import datetime
+from gravityfarms_simulation import configure_logging, hero_banner_variant, run_hero_banner_funnel
+from experiment_config import ConfigWatcher, DEFAULT_CONFIG_PATH
+from stage_profiler import SimulationProfiler, add_profile_arguments
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,66 +18,15 @@ load_dotenv()
 # ---- CONFIGURATION ----
 LD_SDK_KEY = os.getenv("LAUNCHDARKLY_SDK_KEY", "YOUR_SDK_KEY")  # Uses .env if present
 
-# These would be loaded from a config file in a full implementation
-EXPERIMENTS = {
-    "trial_duration": {
-        "flag": "number-of-days-trial",
-        "outcomeMetrics": ["trial_signup", "trial_to_paid_conversion", "total_revenue"],
-        "conversionRates": {
-            "trial_signup": {"US": 0.18, "UK": 0.16, "EU": 0.14, "CA": 0.12},
-            "trial_to_paid_conversion": {"US": 0.45, "UK": 0.42, "EU": 0.38, "CA": 0.35},
-        },
-        "trialDurationMultiplier": {"3": 0.8, "7": 1.0, "14": 1.2, "30": 1.4},
-    },
-    "seasonal_banner": {
-        "flag": "seasonal-sale-banner-text",
-        "outcomeMetrics": ["trial_signup", "banner_click"],
-        "conversionRates": {
-            "trial_signup": {"US": 0.20, "UK": 0.18, "EU": 0.16, "CA": 0.14},
-            "banner_click": {"US": 0.08, "UK": 0.07, "EU": 0.06, "CA": 0.05},
-        },
-    },
-    "hero_banner": {
-        "flag": "hero-banner-text",
-        "outcomeMetrics": ["trial_signup", "hero_engagement"],
-        "conversionRates": {
-            "trial_signup": {"US": 0.19, "UK": 0.17, "EU": 0.15, "CA": 0.13},
-            "hero_engagement": {"US": 0.12, "UK": 0.11, "EU": 0.10, "CA": 0.09},
-        },
-    },
-}
-USER_GENERATION = {
-    "countries": ["US", "UK", "FR", "DE", "CA"],
-    "petTypes": ["dog", "cat", "both"],
-    "planTypes": ["basic", "premium", "trial"],
-    "paymentTypes": ["credit_card", "paypal", "apple_pay", "google_pay", "bank"],
-}
-RANDOMNESS = {"noiseLevel": 0.1}
+# User generation lists and funnel rates are loaded from experiment_config.json
+# (see experiment_config.py) and hot-reloaded while the simulation runs
 
 # ---- SIMULATION LOGIC ----
-def add_randomness(base_rate, noise_level):
-    noise = (random.random() - 0.5) * 2 * noise_level
-    return max(0, min(1, base_rate + noise))
-
-def should_fire_event(metric, country, flag_values, noise_level):
-    region = "EU" if country in ("FR", "DE") else country
-    base_rate = 0
-    for experiment in EXPERIMENTS.values():
-        if metric in experiment["outcomeMetrics"]:
-            base_rate = experiment["conversionRates"].get(metric, {}).get(region, 0)
-            break
-    # Apply trial duration multiplier if applicable
-    if metric == "trial_signup" and "trialDays" in flag_values:
-        multiplier = EXPERIMENTS["trial_duration"]["trialDurationMultiplier"].get(str(flag_values["trialDays"]), 1.0)
-        base_rate *= multiplier
-    final_rate = add_randomness(base_rate, noise_level)
-    return random.random() < final_rate
-
-def generate_user(fake):
-    country = random.choice(USER_GENERATION["countries"])
-    pet_type = random.choice(USER_GENERATION["petTypes"])
-    plan_type = random.choice(USER_GENERATION["planTypes"])
-    payment_type = random.choice(USER_GENERATION["paymentTypes"])
+def generate_user(fake, config):
+    country = random.choice(config.countries)
+    pet_type = random.choice(config.pet_types)
+    plan_type = random.choice(config.plan_types)
+    payment_type = random.choice(config.payment_types)
     if country == "US":
         state = fake.state()
     elif country == "CA":
@@ -110,30 +63,17 @@ def generate_revenue_amount(plan_type, country):
     revenue = base_price * variation
     return round(revenue, 2)
 
-def calculate_adjusted_revenue(total_revenue, trial_days, plan_type, country):
-    """Calculate adjusted revenue by subtracting the cost of free trial days"""
-    base_prices = {
-        "basic": {"US": 29.99, "CA": 39.99, "UK": 24.99, "EU": 27.99},
-        "premium": {"US": 49.99, "CA": 64.99, "UK": 39.99, "EU": 44.99},
-        "deluxe": {"US": 79.99, "CA": 99.99, "UK": 59.99, "EU": 66.99}
-    }
-    region = "EU" if country in ("FR", "DE") else country
-    monthly_price = base_prices.get(plan_type, base_prices["basic"]).get(region, base_prices["basic"]["US"])
-    daily_rate = monthly_price / 30
-    trial_cost = daily_rate * trial_days
-    adjusted_revenue = total_revenue - trial_cost
-    adjusted_revenue = max(0, adjusted_revenue)
-    return round(adjusted_revenue, 2)
-
 def evaluate_flags(ldclient, context):
+    # Per-flag calls on purpose: this script writes no assignment log, so the evaluation
+    # events are the only record of exposures (all_flags_state snapshots send none)
     trial_days = ldclient.variation("number-of-days-trial", context, 7)
     seasonal_banner = ldclient.variation("seasonal-sale-banner-text", context, "")
     hero_banner = ldclient.variation("hero-banner-text", context, {})
     return {"trialDays": trial_days, "seasonalBanner": seasonal_banner, "heroBanner": hero_banner}
 
-def simulate_user_journey(ldclient, fake, noise_level):
+def simulate_user_journey(ldclient, fake, config):
     import datetime
-    user = generate_user(fake)
+    user = generate_user(fake, config)
     context = (
         Context.builder(user["key"])
         .anonymous(False)
@@ -158,75 +98,45 @@ def simulate_user_journey(ldclient, fake, noise_level):
     events = ["page_view"]
 
     # Branch simulation logic based on heroBanner variation
-    hero_banner_text = None
-    if isinstance(flag_values["heroBanner"], dict):
-        hero_banner_text = flag_values["heroBanner"].get("banner-text", "")
-    else:
-        hero_banner_text = str(flag_values["heroBanner"])
-
-    # Simulate different conversion rates and revenue for each hero banner variant
-    variant_conversion_rate = {
-        "Control": 0.05,
-        "Variant 1": 0.07,
-        "Next Generation": 0.09
-    }
-    variant_revenue_mean = {
-        "Control": 30.0,
-        "Variant 1": 35.0,
-        "Next Generation": 40.0
-    }
-    variant = "Control"
-    if "control" in hero_banner_text.lower():
-        variant = "Control"
-    elif "next" in hero_banner_text.lower():
-        variant = "Next Generation"
-    elif "variant" in hero_banner_text.lower() or "top" in hero_banner_text.lower():
-        variant = "Variant 1"
-
-    if random.random() < variant_conversion_rate[variant]:
-        events.append("trial_signup")
-        print(f"[DEBUG] Tracking event: trial_signup for user: {user['key']} at {datetime.datetime.now().isoformat()} (variant: {variant})")
-        ldclient.track("trial_signup", context)
-        if random.random() < 0.5:
-            events.append("trial_to_paid_conversion")
-            print(f"[DEBUG] Tracking event: trial_to_paid_conversion for user: {user['key']} at {datetime.datetime.now().isoformat()} (variant: {variant})")
-            ldclient.track("trial_to_paid_conversion", context)
-            events.append("total_revenue")
-            revenue_amount = random.gauss(variant_revenue_mean[variant], 5.0)
-            revenue_amount = max(0, round(revenue_amount, 2))
-            print(f"[DEBUG] Tracking event: total_revenue for user: {user['key']} value: {revenue_amount} at {datetime.datetime.now().isoformat()} (variant: {variant})")
-            ldclient.track("total_revenue", context, metric_value=revenue_amount)
-            events.append("adjusted_revenue")
-            adjusted_revenue = calculate_adjusted_revenue(
-                revenue_amount,
-                flag_values["trialDays"],
-                user["planType"],
-                user["country"]
-            )
-            print(f"[DEBUG] Tracking event: adjusted_revenue for user: {user['key']} value: {adjusted_revenue} at {datetime.datetime.now().isoformat()} (variant: {variant})")
-            ldclient.track("adjusted_revenue", context, metric_value=adjusted_revenue)
-    if flag_values["seasonalBanner"] and random.random() < 0.1:
-        events.append("banner_click")
-        print(f"[DEBUG] Tracking event: banner_click for user: {user['key']} at {datetime.datetime.now().isoformat()} (variant: {variant})")
-        ldclient.track("banner_click", context)
-    if random.random() < 0.15:
-        events.append("hero_engagement")
-        print(f"[DEBUG] Tracking event: hero_engagement for user: {user['key']} at {datetime.datetime.now().isoformat()} (variant: {variant})")
-        ldclient.track("hero_engagement", context)
+    variant = hero_banner_variant(flag_values["heroBanner"])
+    outcomes = run_hero_banner_funnel(
+        variant, user, flag_values["trialDays"], flag_values["seasonalBanner"], model=config.funnel_model
+    )
+    # Every event carries the config version it was generated under
+    event_data = config.event_data()
+    for event_key, event_value in outcomes:
+        events.append(event_key)
+        if event_value is None:
+            print(f"[DEBUG] Tracking event: {event_key} for user: {user['key']} at {datetime.datetime.now().isoformat()} (variant: {variant})")
+            ldclient.track(event_key, context, data=event_data)
+        else:
+            print(f"[DEBUG] Tracking event: {event_key} for user: {user['key']} value: {event_value} at {datetime.datetime.now().isoformat()} (variant: {variant})")
+            ldclient.track(event_key, context, data=event_data, metric_value=event_value)
     return user, flag_values, events
 
-def main(duration, records_per_second):
+def main(duration, records_per_second, config_path=DEFAULT_CONFIG_PATH,
+         config_poll_interval=1.0, profiler=None):
     fake = Faker()
+    watcher = ConfigWatcher(config_path, interval=config_poll_interval)
+    print(f"Loaded config {watcher.acquire().version} from {config_path}")
+    if config_poll_interval > 0:
+        watcher.start()
     ldclient = LDClient(Config(sdk_key=LD_SDK_KEY))
+    if profiler:
+        profiler.instrument_client(ldclient)
     total_records = duration * records_per_second
     results = {
         "totalUsers": 0,
         "events": defaultdict(int),
         "flagEvaluations": defaultdict(lambda: defaultdict(int)),
+        "configVersions": defaultdict(int),
     }
     for i in range(total_records):
-        user, flag_values, events = simulate_user_journey(ldclient, fake, RANDOMNESS["noiseLevel"])
+        # Config is fixed per journey; a reload takes effect at the next user
+        config = watcher.acquire()
+        user, flag_values, events = simulate_user_journey(ldclient, fake, config)
         results["totalUsers"] += 1
+        results["configVersions"][config.version] += 1
         for event in events:
             results["events"][event] += 1
         for flag, value in flag_values.items():
@@ -239,16 +149,33 @@ def main(duration, records_per_second):
         if (i + 1) % records_per_second == 0:
             print(f"Progress: {i + 1}/{total_records} users ({((i + 1) / total_records) * 100:.1f}%)")
             time.sleep(1)
+    watcher.stop()
     ldclient.close()
     print("Simulation complete!")
     print("Results:")
     print(f"Total Users: {results['totalUsers']}")
     print("Events:", dict(results["events"]))
     print("Flag Evaluations:", {k: dict(v) for k, v in results["flagEvaluations"].items()})
+    print(f"Config Versions: {dict(results['configVersions'])} ({watcher.swaps} reloads, {watcher.rejected} rejected)")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="LaunchDarkly Data Simulation")
     parser.add_argument("--duration", type=int, default=600, help="Simulation duration in seconds")
     parser.add_argument("--records-per-second", type=int, default=1, help="Users per second")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="Experiment and population config file")
+    parser.add_argument("--config-poll-interval", type=float, default=1.0,
+                        help="Seconds between config file change checks (0 disables hot reload)")
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    main(args.duration, args.records_per_second) 
+    configure_logging()
+    profiler = None
+    if args.profile:
+        profiler = SimulationProfiler(args.profile, args.profile_output, args.profile_interval_ms)
+        profiler.instrument_module(sys.modules[__name__], {"generate_user": "generate_user_context"})
+        profiler.start()
+    try:
+        main(args.duration, args.records_per_second, args.config, args.config_poll_interval,
+             profiler=profiler)
+    finally:
+        if profiler:
+            profiler.stop() 
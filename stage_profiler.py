@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Profiling hooks for simulation runs.
+
+SimulationProfiler combines a whole-program profiler with per-stage timers:
+
+- 'sample' mode runs a background thread that snapshots every thread's
+  stack with sys._current_frames() every few milliseconds and writes
+  collapsed stacks ("root;caller;callee count" lines) to <output>.folded,
+  ready for flamegraph.pl or speedscope. Overhead stays low because nothing
+  is hooked into the profiled code.
+- 'cprofile' mode uses cProfile (deterministic, higher overhead; best for
+  short runs) and writes <output>.pstats plus a top-functions summary. It
+  also writes <output>.folded, reconstructed from the caller/callee graph:
+  cProfile only records call edges, so a callee's time is split across its
+  callers in proportion to the time each edge accounts for. Only the thread
+  that started profiling is covered.
+
+Stage timers wrap functions and client methods only when profiling is on,
+so unprofiled runs pay nothing. The stage report divides each stage's time
+by the number of generated users (calls of the generate_user_context stage)
+and writes it to <output>.stages.json.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger('gravityfarms-profile')
+
+USER_STAGE = 'generate_user_context'
+CLIENT_STAGES = {
+    'variation': 'flag_evaluation',
+    'variation_detail': 'flag_evaluation',
+    'all_flags_state': 'flag_evaluation',
+    'track': 'track',
+    'flush': 'flush',
+}
+# Stages that run on background threads (spool delivery) rather than in the journey loop
+BACKGROUND_STAGES = {'sink_delivery'}
+
+
+class StageTimers:
+    """Thread-safe call counts and cumulative wall time per named stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                self._stages[stage] = [1, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        timed.__wrapped_stage__ = stage
+        return timed
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: tuple(entry) for stage, entry in self._stages.items()}
+
+
+class StackSampler(threading.Thread):
+    """Samples all thread stacks at a fixed interval into collapsed-stack counts."""
+
+    def __init__(self, interval=0.005):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def _label(code):
+        return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+    def run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _pstats_label(func):
+    filename, _, name = func
+    if filename == '~':
+        # Built-ins are keyed ('~', 0, '<built-in method time.sleep>')
+        return name
+    return f"{os.path.basename(filename)}:{name}"
+
+
+def write_pstats_folded(stats, path, root='MainThread', min_us=1, max_depth=128):
+    """
+    Write collapsed stacks (weights in microseconds) approximated from a pstats call graph.
+
+    Walks down from functions with no recorded callers. The share of a callee
+    attributed to a path is the path's share of the caller times the fraction
+    of the callee's cumulative time that came from that caller; each frame's
+    own time is emitted with that share. Recursive edges are cut.
+    """
+    entries = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            # edge is (call count, primitive calls, own time, cumulative time) for this caller
+            callees.setdefault(caller, []).append((func, edge[3]))
+    folded = Counter()
+
+    def walk(func, stack, share, depth):
+        _, _, own, cumulative, _ = entries[func]
+        weight = int(own * share * 1e6)
+        if weight >= min_us:
+            folded[';'.join(stack)] += weight
+        if depth >= max_depth:
+            return
+        for callee, edge_cumulative in callees.get(func, ()):
+            callee_cumulative = entries[callee][3]
+            if callee_cumulative <= 0 or _pstats_label(callee) in stack:
+                continue
+            callee_share = share * edge_cumulative / callee_cumulative
+            if callee_cumulative * callee_share * 1e6 < min_us:
+                continue
+            walk(callee, stack + [_pstats_label(callee)], callee_share, depth + 1)
+
+    for func, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(func, [root, _pstats_label(func)], 1.0, 0)
+    with open(path, 'w') as f:
+        for stack, weight in folded.most_common():
+            f.write(f"{stack} {weight}\n")
+    return len(folded)
+
+
+class SimulationProfiler:
+    """Whole-run profiler plus per-stage timers for one simulation entry point."""
+
+    def __init__(self, mode='sample', output=None, interval_ms=5.0):
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.output = output or f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.interval_ms = interval_ms
+        self.timers = StageTimers()
+        self._restore = []
+        self._sampler = None
+        self._cprofile = None
+        self._started = None
+
+    def instrument_module(self, module, stages):
+        """Replace module-level functions with timed wrappers; stages maps attribute name -> stage."""
+        for attr, stage in stages.items():
+            original = getattr(module, attr)
+            setattr(module, attr, self.timers.wrap(stage, original))
+            self._restore.append((module, attr, original))
+
+    def instrument_object(self, obj, stages):
+        """Time bound methods of one object (an LD client, spool, rollup sink) as instance attributes."""
+        for attr, stage in stages.items():
+            method = getattr(obj, attr, None)
+            if method is not None and not hasattr(method, '__wrapped_stage__'):
+                setattr(obj, attr, self.timers.wrap(stage, method))
+        return obj
+
+    def instrument_client(self, ld_client):
+        return self.instrument_object(ld_client, CLIENT_STAGES)
+
+    def start(self):
+        self._started = time.perf_counter()
+        if self.mode == 'cprofile':
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        else:
+            self._sampler = StackSampler(self.interval_ms / 1000)
+            self._sampler.start()
+        logger.info(f"Profiling enabled ({self.mode}); output prefix {self.output}")
+        return self
+
+    def stop(self):
+        """Stop profiling, restore instrumented functions and write all outputs; returns the stage report."""
+        wall = time.perf_counter() - self._started
+        if self._cprofile:
+            import pstats
+            self._cprofile.disable()
+            self._cprofile.dump_stats(f"{self.output}.pstats")
+            stats = pstats.Stats(self._cprofile)
+            stacks = write_pstats_folded(stats, f"{self.output}.folded")
+            logger.info(f"cProfile stats written to {self.output}.pstats; {stacks} reconstructed stacks "
+                        f"(weights in microseconds) written to {self.output}.folded")
+            stats.sort_stats('cumulative').print_stats(20)
+        if self._sampler:
+            self._sampler.stop()
+            self._sampler.write_folded(f"{self.output}.folded")
+            logger.info(f"{self._sampler.samples} stack samples written to {self.output}.folded "
+                        f"(render with flamegraph.pl or speedscope)")
+        for module, attr, original in reversed(self._restore):
+            setattr(module, attr, original)
+        self._restore.clear()
+
+        report = self.stage_report(wall)
+        with open(f"{self.output}.stages.json", 'w') as f:
+            json.dump(report, f, indent=2)
+        print_stage_report(report)
+        return report
+
+    def stage_report(self, wall):
+        stages = self.timers.snapshot()
+        users = stages.get(USER_STAGE, (0, 0.0))[0]
+        rows = {}
+        for stage, (calls, seconds) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            rows[stage] = {
+                'calls': calls,
+                'seconds': seconds,
+                'calls_per_user': calls / users if users else None,
+                'ms_per_user': seconds * 1000 / users if users else None,
+                'share_of_wall': seconds / wall if wall else None,
+            }
+        other = max(0.0, wall - sum(seconds for stage, (_, seconds) in stages.items() if stage not in BACKGROUND_STAGES))
+        return {
+            'mode': self.mode,
+            'wall_seconds': wall,
+            'users': users,
+            'users_per_second': users / wall if wall else 0.0,
+            'stages': rows,
+            'other_ms_per_user': other * 1000 / users if users else None,
+        }
+
+
+def print_stage_report(report):
+    users = report['users']
+    print(f"\nStage timings: {users} users in {report['wall_seconds']:.2f}s ({report['users_per_second']:.1f} users/s)")
+    print(f"{'Stage':<28} {'Calls':>9} {'Calls/user':>10} {'ms/user':>9} {'% wall':>7}")
+    for stage, row in report['stages'].items():
+        calls_per_user = f"{row['calls_per_user']:.2f}" if row['calls_per_user'] is not None else '-'
+        ms_per_user = f"{row['ms_per_user']:.3f}" if row['ms_per_user'] is not None else '-'
+        print(f"{stage:<28} {row['calls']:>9} {calls_per_user:>10} {ms_per_user:>9} {row['share_of_wall'] * 100:>6.1f}%")
+    if report['other_ms_per_user'] is not None:
+        print(f"{'other (sleeps, logging, ...)':<28} {'':>9} {'':>10} {report['other_ms_per_user']:>9.3f}")
+
+
+def add_profile_arguments(parser):
+    """Add the shared --profile options to an entry point's argparse parser."""
+    parser.add_argument('--profile', choices=['sample', 'cprofile'],
+                        help='Profile the run: low-overhead stack sampling or cProfile; both write collapsed stacks to <prefix>.folded')
+    parser.add_argument('--profile-output', help='Output path prefix for profile files (default: profile_<timestamp>)')
+    parser.add_argument('--profile-interval-ms', type=float, default=5.0, help='Stack sampling interval')
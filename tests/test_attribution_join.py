@@ -0,0 +1,72 @@
+import os
+import sys
+import uuid
+import random
+from collections import Counter, defaultdict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attribution_join import RunWriter, TABLE_OVERHEAD, _join, _run_files, partition_of
+
+PARTITIONS = 8
+SKEWED = 3
+
+
+def _partition_keys(count=40000, seed=7):
+    rng = random.Random(seed)
+    keys = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(count)]
+    return [key for key in keys if partition_of(key, PARTITIONS) == SKEWED]
+
+
+@pytest.mark.parametrize('fanout', [2, 3, 4])
+@pytest.mark.parametrize('salt', [1, 2, 3])
+def test_resplit_divides_a_partition(fanout, salt):
+    keys = _partition_keys()
+    counts = Counter(partition_of(key, fanout, salt) for key in keys)
+    assert len(counts) == fanout
+    expected = len(keys) / fanout
+    assert all(abs(n - expected) < expected * 0.1 for n in counts.values()), counts
+
+
+def test_resplits_at_different_depths_are_independent():
+    keys = _partition_keys()
+    first = [key for key in keys if partition_of(key, 2, 1) == 0]
+    counts = Counter(partition_of(key, 2, 2) for key in first)
+    assert min(counts.values()) > len(first) * 0.4, counts
+
+
+def test_skewed_partition_splits_once_and_joins_every_event(tmp_path):
+    keys = _partition_keys(count=16000)
+    spill_dir = tmp_path / 'spill'
+    spill_dir.mkdir()
+    assign = RunWriter(str(spill_dir), 'assign-t00000', PARTITIONS, 4096)
+    events = RunWriter(str(spill_dir), 'events-t00000', PARTITIONS, 4096)
+    for n, key in enumerate(keys):
+        assign.write(SKEWED, [key, 'Control', 7, '', n])
+        events.write(SKEWED, [key, f'e{n}', 'trial_signup', None, '2024-01-01T00:00:00'])
+    assign.close()
+    events.close()
+
+    assign_paths = _run_files(str(spill_dir), 'assign', SKEWED)
+    event_paths = _run_files(str(spill_dir), 'events', SKEWED)
+    assign_bytes = sum(os.path.getsize(p) for p in assign_paths)
+    # Over budget by 1.8x: one 2-way split is enough if the split actually divides the keys
+    budget = int(assign_bytes * TABLE_OVERHEAD / 1.8)
+
+    rows = []
+    totals = {'assignments': 0, 'users': 0, 'events': 0, 'unassigned': 0, 'repartitioned': 0,
+              'variants': defaultdict(lambda: defaultdict(lambda: [0, 0, 0.0]))}
+
+    class Rows:
+        def writerow(self, row):
+            rows.append(row)
+
+    _join(assign_paths, event_paths, lambda variant: Rows(), totals, budget,
+          str(tmp_path / 'skew'), 4096)
+
+    assert totals['repartitioned'] == 1
+    assert totals['users'] == len(keys)
+    assert totals['unassigned'] == 0
+    assert sorted(row[0] for row in rows) == sorted(f'e{n}' for n in range(len(keys)))